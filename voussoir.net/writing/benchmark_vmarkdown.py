@@ -0,0 +1,612 @@
+'''
+Benchmarks for vmarkdown.
+'''
+import argparse
+import asyncio
+import bs4
+import contextlib
+import datetime
+import functools
+import glob
+import http.server
+import io
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import vmarkdown
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CSS = os.path.join(HERE, 'dark.css')
+
+# The smallest valid PNG, 1x1 transparent, for the embed_images benchmark.
+TINY_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c4'
+    '890000000d4944415478da63f8ffff3f0005fe02fea7d6a4510000000049454e'
+    '44ae426082'
+)
+
+# Inputs that used to make the recursive supers_many regex backtrack. Each
+# function takes a repetition count and returns the markdown.
+ADVERSARIAL_SUPERS = {
+    'unclosed_opens': lambda n: '^(' + 'word (' * n,
+    'unclosed_pairs': lambda n: '^(' + '(word) ' * n,
+    'unclosed_carets': lambda n: '^(' + '^word ' * n,
+    'deep_nesting': lambda n: '^' + '(' * n + 'word' + ')' * n,
+    'many_openers': lambda n: '^(word ' * n,
+    # Rendering the inside of one ^( used to evict the paragraph's closers
+    # table, so the paragraph got rescanned at every token after it.
+    'nested_supers': lambda n: '^(^(word)) x ' * (n // 2),
+    'supers_in_em': lambda n: '*^(word)* ^(word) x ' * (n // 3),
+}
+
+# For each command, the import time budget in milliseconds, and the modules
+# which it must not import. Those are deferred until they're needed, and this
+# is how we notice if one sneaks back to the top.
+IMPORTTIME_COMMANDS = {
+    'vmarkdown': {
+        'argv': ['-c', 'import vmarkdown'],
+        'budget_ms': 250,
+        'forbidden': ['concurrent.futures', 'flask', 'multiprocessing', 'pygments', 'regex', 'requests'],
+    },
+    'generate_site --help': {
+        'argv': [os.path.join(HERE, 'generate_site.py'), '--help'],
+        'budget_ms': 400,
+        'forbidden': ['etiquette', 'flask', 'numpy', 'pygments', 'requests', 'scipy'],
+    },
+}
+
+def time_call(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+def benchmark_adversarial(sizes, budget, render_budget):
+    '''
+    Time each adversarial input through the supers_many rule by itself and
+    through a full VMARKDOWN render, at growing sizes. The rule should take
+    time proportional to the length of the text, so the microseconds per
+    thousand characters should stay flat down the table. The render column
+    also includes mistune slicing the remaining text after every token, so it
+    grows with the number of tokens as well as their length.
+
+    Return the names of the cases where a single match took longer than
+    `budget` seconds, or the render took longer than `render_budget`.
+    '''
+    pattern = vmarkdown.VoussoirInlineGrammar.supers_many
+    over_budget = []
+    print(f'{"case":<16} {"chars":>9} {"match":>10} {"us/kchar":>9} {"render":>10}')
+    for (name, make) in ADVERSARIAL_SUPERS.items():
+        for size in sizes:
+            md = make(size)
+            match_time = time_call(pattern.match, md)
+            render_time = time_call(vmarkdown.VMARKDOWN, md)
+            per_kchar = 1e6 * match_time / (len(md) / 1000)
+            print(f'{name:<16} {len(md):>9} {match_time:>9.5f}s {per_kchar:>9.2f} {render_time:>9.5f}s')
+            if match_time > budget or render_time > render_budget:
+                over_budget.append(name)
+    return over_budget
+
+def import_time(argv):
+    '''
+    Run python -X importtime with the given argv and return the total
+    microseconds spent on top-level imports, and the set of imported modules.
+    '''
+    command = [sys.executable, '-X', 'importtime', *argv]
+    process = subprocess.run(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    output = process.stderr.decode('utf-8', errors='replace')
+
+    total = 0
+    modules = set()
+    for line in output.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+        if not match:
+            continue
+        modules.add(match.group(4))
+        if len(match.group(3)) == 1:
+            total += int(match.group(2))
+    return (total, modules)
+
+def benchmark_importtime(budget_ms=None):
+    '''
+    Return a list of problems: commands over their budget, or commands which
+    imported one of their forbidden modules. If budget_ms is given, it
+    overrides the budget of every command.
+    '''
+    problems = []
+    for (name, command) in IMPORTTIME_COMMANDS.items():
+        (total, modules) = import_time(command['argv'])
+        budget = command['budget_ms'] if budget_ms is None else budget_ms
+        print(f'{name:<24} {total / 1000:>8.1f}ms')
+        if total / 1000 > budget:
+            problems.append(f'{name} took {total / 1000:.1f}ms, over {budget}ms.')
+        for module in command['forbidden']:
+            if module in modules:
+                problems.append(f'{name} imported {module}.')
+    return problems
+
+# CORPUS BENCHMARKS
+################################################################################
+def corpus_files():
+    return sorted(glob.glob(os.path.join(HERE, '*', '*.md')))
+
+def measure(function, repeat):
+    '''
+    Call function `repeat` times and return the min, median, and every run in
+    seconds. If function returns a float, that's taken as the time of the run
+    instead of the whole call, so that benchmarks can leave their setup out.
+    There's one untimed call first, to get lazy imports and caches warmed up.
+    '''
+    function()
+    runs = []
+    for x in range(repeat):
+        start = time.perf_counter()
+        elapsed = function()
+        if not isinstance(elapsed, float):
+            elapsed = time.perf_counter() - start
+        runs.append(elapsed)
+    return {'min': min(runs), 'median': statistics.median(runs), 'runs': runs}
+
+def pre_cleaner_html(md):
+    '''
+    The html that markdown() would hand to the soup cleaners, so the cleaners
+    can be benchmarked on fresh soups without timing mistune every time.
+    '''
+    body = vmarkdown.VMARKDOWN(md)
+    html = vmarkdown.HTML_TEMPLATE.format(css='', body=body)
+    return vmarkdown.html_replacements(html)
+
+def code_blocks(md):
+    return re.findall(r'^```(\w*)\n(.*?)^```', md, flags=re.MULTILINE | re.DOTALL)
+
+def paragraphs(md):
+    md = re.sub(r'^```.*?^```', '', md, flags=re.MULTILINE | re.DOTALL)
+    return [p for p in re.split(r'\n\s*\n', md) if p.strip()]
+
+@contextlib.contextmanager
+def image_server(directory):
+    '''
+    Serve `directory` on localhost so embed_images can be benchmarked against
+    http urls without depending on the real internet.
+    '''
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def benchmark_corpus(repeat, filter=None):
+    '''
+    Render every article in the writing corpus through vmarkdown.markdown,
+    and run micro-benchmarks of the expensive pieces on the corpus's own
+    contents. Return a dict of benchmark name to its measurement.
+    '''
+    files = corpus_files()
+    mds = {os.path.basename(file): vmarkdown.cat_file(file) for file in files}
+    css_text = vmarkdown.cat_file(CSS)
+    benchmarks = {}
+
+    for (name, md) in mds.items():
+        benchmarks[f'render/{name}'] = functools.partial(vmarkdown.markdown, md, css_text=css_text)
+
+    def render_all():
+        for md in mds.values():
+            vmarkdown.markdown(md, css_text=css_text)
+    benchmarks['render/all'] = render_all
+
+    blocks = [block for md in mds.values() for block in code_blocks(md)]
+    def block_code():
+        for (lang, text) in blocks:
+            vmarkdown.SyntaxHighlighting._block_code(text, lang)
+    benchmarks['micro/_block_code'] = block_code
+
+    texts = [p for md in mds.values() for p in paragraphs(md)]
+    def inline_lexer():
+        for text in texts:
+            vmarkdown.inline.output(text)
+    benchmarks['micro/inline_lexer'] = inline_lexer
+
+    htmls = [pre_cleaner_html(md) for md in mds.values()]
+    def soup_cleaner(cleaner, prepare):
+        def run():
+            elapsed = 0
+            for html in htmls:
+                soup = bs4.BeautifulSoup(html, 'html.parser')
+                for step in prepare:
+                    step(soup)
+                start = time.perf_counter()
+                cleaner(soup)
+                elapsed += time.perf_counter() - start
+            return elapsed
+        return run
+    # Each cleaner gets the soup it would have in the real pipeline.
+    prepare_toc = [vmarkdown.add_head_title, vmarkdown.add_header_anchors]
+    benchmarks['micro/add_toc'] = soup_cleaner(vmarkdown.add_toc, prepare_toc)
+    prepare_classes = prepare_toc + [vmarkdown.add_toc]
+    benchmarks['micro/fix_classes'] = soup_cleaner(vmarkdown.fix_classes, prepare_classes)
+
+    headers = [
+        header.get_text()
+        for html in htmls
+        for header in bs4.BeautifulSoup(html, 'html.parser').find_all(re.compile(r'^h[1-6]$'))
+    ]
+    def slugify():
+        for header in headers:
+            vmarkdown.slugify(header)
+    benchmarks['micro/slugify'] = slugify
+
+    if filter is not None:
+        benchmarks = {name: b for (name, b) in benchmarks.items() if re.search(filter, name)}
+
+    results = {}
+    for (name, function) in benchmarks.items():
+        results[name] = measure(function, repeat)
+        print(f'{name:<60} {results[name]["min"]:>10.5f}s')
+
+    if filter is None or re.search(filter, 'micro/embed_images'):
+        name = 'micro/embed_images'
+        results[name] = benchmark_embed_images(repeat)
+        print(f'{name:<60} {results[name]["min"]:>10.5f}s')
+
+    return results
+
+def benchmark_embed_images(repeat, count=20):
+    '''
+    Embed `count` local images and `count` images from a local http server,
+    with an empty cache every time so each one is really loaded.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        for x in range(count):
+            with open(os.path.join(directory, f'{x}.png'), 'wb') as f:
+                f.write(TINY_PNG)
+
+        with image_server(directory) as base_url:
+            imgs = [f'<img src="{os.path.join(directory, f"{x}.png")}"/>' for x in range(count)]
+            imgs += [f'<img src="{base_url}/{x}.png"/>' for x in range(count)]
+            html = '<html><body>' + ''.join(imgs) + '</body></html>'
+
+            def run():
+                soup = bs4.BeautifulSoup(html, 'html.parser')
+                start = time.perf_counter()
+                # embed_images prints every fetch.
+                with contextlib.redirect_stdout(io.StringIO()):
+                    vmarkdown.embed_images(soup, cache={})
+                return time.perf_counter() - start
+            return measure(run, repeat)
+
+def compare_results(baseline, current, threshold, stat='min'):
+    '''
+    Return the names of benchmarks which are more than `threshold` (a
+    fraction, 0.1 = 10%) slower in `current` than in `baseline`.
+    '''
+    regressions = []
+    print(f'{"benchmark":<60} {"baseline":>10} {"current":>10} {"change":>8}')
+    for (name, result) in current['results'].items():
+        if name not in baseline['results']:
+            print(f'{name:<60} {"":>10} {result[stat]:>9.5f}s {"new":>8}')
+            continue
+        before = baseline['results'][name][stat]
+        after = result[stat]
+        change = (after - before) / before if before else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print(f'{name:<60} {before:>9.5f}s {after:>9.5f}s {change:>+7.1%}{flag}')
+    return regressions
+
+# LOAD TEST
+################################################################################
+async def http_get(host, port, path):
+    '''
+    A deliberately tiny asyncio HTTP/1.1 client, so the load test doesn't
+    need aiohttp. One connection per request with Connection: close, which is
+    what the flask development server does anyway. Return the status code
+    and the number of body bytes.
+    '''
+    (reader, writer) = await asyncio.open_connection(host, port)
+    try:
+        request = (
+            f'GET {path} HTTP/1.1\r\n'
+            f'Host: {host}:{port}\r\n'
+            'Accept-Encoding: gzip\r\n'
+            'Connection: close\r\n'
+            '\r\n'
+        )
+        writer.write(request.encode('ascii'))
+        await writer.drain()
+        status_line = await reader.readline()
+        status = int(status_line.split()[1])
+        while (await reader.readline()) not in (b'\r\n', b''):
+            pass
+        size = 0
+        while True:
+            chunk = await reader.read(2**16)
+            if not chunk:
+                break
+            size += len(chunk)
+        return (status, size)
+    finally:
+        writer.close()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+def process_rss_mb(pid):
+    '''
+    Current RSS of the process in megabytes, from /proc. Returns None where
+    there is no /proc.
+    '''
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        return None
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def make_load_site(directory, static_mb):
+    '''
+    Copy the writing corpus into `directory` along with one large media file,
+    and return the url paths of the markdown pages, the directory listings,
+    and the static file.
+    '''
+    for md in corpus_files():
+        folder = os.path.dirname(md)
+        shutil.copytree(folder, os.path.join(directory, os.path.basename(folder)), ignore=shutil.ignore_patterns('*.html'))
+    with open(os.path.join(directory, 'media.mp4'), 'wb') as f:
+        for x in range(static_mb):
+            f.write(os.urandom(2**20))
+
+    pages = []
+    listings = ['/']
+    for name in sorted(os.listdir(directory)):
+        if os.path.isdir(os.path.join(directory, name)):
+            listings.append(f'/{name}')
+            pages.append(f'/{name}/{name}.md')
+    return {'md': pages, 'listing': listings, 'static': ['/media.mp4']}
+
+async def run_load(port, paths, mix, concurrency, duration, server_pid):
+    '''
+    Keep `concurrency` clients busy for `duration` seconds, each picking the
+    kind of request by the weights in `mix`, while sampling the server's RSS.
+    '''
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    rng = random.Random(0)
+    records = []
+    rss = []
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        while time.perf_counter() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            path = rng.choice(paths[kind])
+            start = time.perf_counter()
+            try:
+                (status, size) = await http_get('127.0.0.1', port, path)
+            except OSError:
+                (status, size) = (None, 0)
+            records.append((kind, time.perf_counter() - start, status, size))
+
+    async def sampler():
+        while time.perf_counter() < deadline:
+            sample = process_rss_mb(server_pid)
+            if sample is not None:
+                rss.append(sample)
+            await asyncio.sleep(0.2)
+
+    start = time.perf_counter()
+    await asyncio.gather(sampler(), *(client() for x in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return (records, rss, elapsed)
+
+def summarize_load(records, rss, elapsed):
+    def summary(subset):
+        latencies = [latency for (kind, latency, status, size) in subset]
+        return {
+            'requests': len(subset),
+            'errors': sum(1 for record in subset if record[2] != 200),
+            'p50_ms': 1000 * percentile(latencies, 0.50) if subset else None,
+            'p99_ms': 1000 * percentile(latencies, 0.99) if subset else None,
+            'requests_per_second': len(subset) / elapsed,
+            'mb_per_second': sum(record[3] for record in subset) / elapsed / 2**20,
+        }
+    result = {'seconds': elapsed, 'all': summary(records), 'kinds': {}}
+    for kind in sorted({record[0] for record in records}):
+        result['kinds'][kind] = summary([record for record in records if record[0] == kind])
+    if rss:
+        result['rss_mb'] = {'start': rss[0], 'peak': max(rss), 'end': rss[-1]}
+    return result
+
+def print_load(result):
+    print(f'{"kind":<10} {"requests":>9} {"errors":>7} {"p50":>9} {"p99":>9} {"req/s":>8} {"MB/s":>8}')
+    rows = [*result['kinds'].items(), ('all', result['all'])]
+    for (kind, row) in rows:
+        if not row['requests']:
+            continue
+        print(
+            f'{kind:<10} {row["requests"]:>9} {row["errors"]:>7} '
+            f'{row["p50_ms"]:>7.1f}ms {row["p99_ms"]:>7.1f}ms '
+            f'{row["requests_per_second"]:>8.1f} {row["mb_per_second"]:>8.1f}'
+        )
+    if 'rss_mb' in result:
+        rss = result['rss_mb']
+        print(f'server rss: {rss["start"]:.1f}MB at start, {rss["peak"]:.1f}MB peak, {rss["end"]:.1f}MB at end')
+
+def load_test(mix, concurrency, duration, static_mb, server_args=[]):
+    '''
+    Start a markdown_flask server on a copy of the corpus, wait for it to
+    come up, and hammer it. The server is a separate process so that its RSS
+    is its own and the load generator doesn't steal its GIL.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_load_site(directory, static_mb)
+        port = free_port()
+        command = [
+            sys.executable, os.path.join(HERE, 'vmarkdown.py'), directory,
+            '--server', str(port), '--css', CSS, *server_args,
+        ]
+        server = subprocess.Popen(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for x in range(100):
+                try:
+                    socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                    break
+                except OSError:
+                    if server.poll() is not None:
+                        raise ValueError(f'The server exited with {server.returncode}.')
+                    time.sleep(0.1)
+            else:
+                raise ValueError('The server did not start.')
+
+            (records, rss, elapsed) = asyncio.run(
+                run_load(port, paths, mix, concurrency, duration, server.pid)
+            )
+        finally:
+            server.terminate()
+            server.wait()
+    return summarize_load(records, rss, elapsed)
+
+# COMMAND LINE
+################################################################################
+def adversarial_argparse(args):
+    over_budget = benchmark_adversarial(
+        sizes=args.sizes,
+        budget=args.budget,
+        render_budget=args.render_budget,
+    )
+    if over_budget:
+        print(f'Over the {args.budget}s match or {args.render_budget}s render budget: {", ".join(sorted(set(over_budget)))}')
+        return 1
+    return 0
+
+def importtime_argparse(args):
+    problems = benchmark_importtime(budget_ms=args.budget)
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+def run_argparse(args):
+    results = benchmark_corpus(repeat=args.repeat, filter=args.filter)
+    output = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=4)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, output, threshold=args.threshold, stat=args.stat)
+        return 1 if regressions else 0
+    return 0
+
+def compare_argparse(args):
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.current, 'r', encoding='utf-8') as f:
+        current = json.load(f)
+    regressions = compare_results(baseline, current, threshold=args.threshold, stat=args.stat)
+    if regressions:
+        print(f'{len(regressions)} regressions over {args.threshold:.0%}.')
+        return 1
+    return 0
+
+def load_argparse(args):
+    mix = {}
+    for part in args.mix.split(','):
+        (kind, weight) = part.split('=')
+        if kind not in ('md', 'listing', 'static'):
+            raise ValueError(f'Unknown request kind {kind}.')
+        mix[kind] = float(weight)
+    server_args = ['--prerender'] if args.prerender else []
+    result = load_test(
+        mix=mix,
+        concurrency=args.concurrency,
+        duration=args.duration,
+        static_mb=args.static_mb,
+        server_args=server_args,
+    )
+    print_load(result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=4)
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p_adversarial = subparsers.add_parser('adversarial')
+    p_adversarial.add_argument('--sizes', dest='sizes', nargs='+', type=int, default=[100, 1000, 10000, 100000])
+    p_adversarial.add_argument('--budget', dest='budget', type=float, default=0.5)
+    p_adversarial.add_argument('--render_budget', '--render-budget', dest='render_budget', type=float, default=10.0)
+    p_adversarial.set_defaults(func=adversarial_argparse)
+
+    p_importtime = subparsers.add_parser('importtime')
+    p_importtime.add_argument('--budget', dest='budget', type=float, default=None)
+    p_importtime.set_defaults(func=importtime_argparse)
+
+    p_run = subparsers.add_parser('run')
+    p_run.add_argument('--repeat', dest='repeat', type=int, default=5)
+    p_run.add_argument('--filter', dest='filter', default=None)
+    p_run.add_argument('--output', '-o', dest='output', default=None)
+    p_run.add_argument('--baseline', dest='baseline', default=None)
+    p_run.add_argument('--threshold', dest='threshold', type=float, default=0.1)
+    p_run.add_argument('--stat', dest='stat', choices=['min', 'median'], default='min')
+    p_run.set_defaults(func=run_argparse)
+
+    p_compare = subparsers.add_parser('compare')
+    p_compare.add_argument('baseline')
+    p_compare.add_argument('current')
+    p_compare.add_argument('--threshold', dest='threshold', type=float, default=0.1)
+    p_compare.add_argument('--stat', dest='stat', choices=['min', 'median'], default='min')
+    p_compare.set_defaults(func=compare_argparse)
+
+    p_load = subparsers.add_parser('load')
+    p_load.add_argument('--mix', dest='mix', default='md=6,listing=2,static=2')
+    p_load.add_argument('--concurrency', dest='concurrency', type=int, default=16)
+    p_load.add_argument('--duration', dest='duration', type=float, default=10)
+    p_load.add_argument('--static_mb', '--static-mb', dest='static_mb', type=int, default=20)
+    p_load.add_argument('--prerender', dest='prerender', action='store_true')
+    p_load.add_argument('--output', '-o', dest='output', default=None)
+    p_load.set_defaults(func=load_argparse)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    raise SystemExit(main(sys.argv[1:]))
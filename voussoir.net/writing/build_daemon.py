@@ -0,0 +1,264 @@
+'''
+A resident process that keeps vmarkdown, generate_site and their heavy
+imports warm, and takes render and build requests over a Unix socket, so that
+editor plugins and hooks which run them over and over don't pay for python
+startup and imports every time.
+
+    build_daemon.py serve &
+    build_daemon.py render article.md --css dark.css -o article.html
+    build_daemon.py build -- --dynamic_tags
+    build_daemon.py stop
+
+If the daemon isn't running, render and build just do the work in-process,
+so they're always safe to call. That includes platforms without Unix sockets,
+like Windows, where there's never a daemon to talk to.
+
+The protocol is one line of json in and one line of json out per connection.
+Requests are handled one at a time, because neither markdown() nor the build
+is safe to run concurrently.
+'''
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+UNIX_SOCKETS = hasattr(socket, 'AF_UNIX') and hasattr(socketserver, 'UnixStreamServer')
+
+def default_socket():
+    # One per user, since each user's daemon writes files as them.
+    if hasattr(os, 'getuid'):
+        name = f'voussoir_build_{os.getuid()}.sock'
+    else:
+        name = 'voussoir_build.sock'
+    return os.path.join(tempfile.gettempdir(), name)
+
+# The same request run in the daemon or in-process.
+def do_render(request, render_caches=None):
+    '''
+    Render one markdown file. In the daemon, render_caches keeps a RenderCache
+    per set of options, so re-rendering an unchanged file is a dict lookup.
+    '''
+    import vmarkdown
+    css = tuple(request.get('css') or [])
+    options = {'css': list(css), 'do_embed_images': bool(request.get('embed_images'))}
+    if render_caches is None:
+        md_filename = os.path.abspath(request['md_filename'])
+        html = vmarkdown.markdown(
+            vmarkdown.cat_file(md_filename),
+            base_dir=os.path.dirname(md_filename),
+            **options,
+        )
+    else:
+        key = (css, options['do_embed_images'])
+        cache = render_caches.get(key)
+        if cache is None:
+            cache = vmarkdown.RenderCache(**options)
+            render_caches[key] = cache
+        html = cache.get(os.path.abspath(request['md_filename'])).html
+
+    if request.get('output_filename'):
+        with open(request['output_filename'], 'w', encoding='utf-8') as f:
+            f.write(html)
+        return {'status': 0}
+    return {'status': 0, 'html': html}
+
+def do_build(request):
+    import generate_site
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            status = generate_site.main(request.get('argv', []))
+        except SystemExit as exc:
+            # argparse exits on bad arguments, but the daemon shouldn't.
+            status = exc.code
+    return {'status': status or 0, 'output': output.getvalue()}
+
+# DAEMON
+################################################################################
+def warm_up():
+    '''
+    Import everything a request might need and do one throwaway render, so
+    the first real request is as fast as the rest.
+    '''
+    # Nothing here uses generate_site, but build requests will, and importing
+    # it once puts it and its dependencies in sys.modules for them.
+    importlib.import_module('generate_site')
+    import vmarkdown
+    # Rendering a code block is what loads pygments and its lexers.
+    vmarkdown.markdown('# warm\n\n```python\nx = 1\n```\n')
+    try:
+        import etiquette
+        etiquette.photodb.PhotoDB(ephemeral=True).log.setLevel(100)
+    except ImportError:
+        pass
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        start = time.perf_counter()
+        previous_cwd = os.getcwd()
+        try:
+            os.chdir(request.get('cwd', previous_cwd))
+            command = request.get('command')
+            if command == 'render':
+                response = do_render(request, self.server.render_caches)
+            elif command == 'build':
+                response = do_build(request)
+            elif command == 'ping':
+                response = {'status': 0}
+            elif command == 'stop':
+                response = {'status': 0}
+                # shutdown waits for serve_forever to return, so it can't be
+                # called from the thread that's serving this request.
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                response = {'status': 1, 'error': f'Unknown command {command}.'}
+        except Exception:
+            response = {'status': 1, 'error': traceback.format_exc()}
+        finally:
+            os.chdir(previous_cwd)
+        response['seconds'] = time.perf_counter() - start
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+def serve(socket_path):
+    if not UNIX_SOCKETS:
+        raise ValueError('The daemon needs Unix sockets, which this platform does not have.')
+
+    class Daemon(socketserver.UnixStreamServer):
+        def __init__(self, socket_path):
+            self.render_caches = {}
+            super().__init__(socket_path, DaemonHandler)
+            # Anyone who can connect can make us write files.
+            os.chmod(socket_path, 0o600)
+
+    if os.path.exists(socket_path):
+        if ping(socket_path):
+            raise ValueError(f'A daemon is already listening on {socket_path}.')
+        os.remove(socket_path)
+
+    warm_up()
+    with Daemon(socket_path) as daemon:
+        print(f'Listening on {socket_path}.')
+        try:
+            daemon.serve_forever(poll_interval=0.1)
+        finally:
+            os.remove(socket_path)
+
+# CLIENT
+################################################################################
+def send(socket_path, request):
+    '''
+    Send the request to the daemon and return its response, or None if there
+    is no daemon to talk to.
+    '''
+    if not UNIX_SOCKETS:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+
+    with sock:
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(2**16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b''.join(chunks))
+
+def ping(socket_path):
+    return send(socket_path, {'command': 'ping'}) is not None
+
+def run(socket_path, request, local):
+    '''
+    Send the request to the daemon if there is one, otherwise call `local`
+    right here.
+    '''
+    request['cwd'] = os.getcwd()
+    response = send(socket_path, request)
+    if response is not None:
+        return response
+    try:
+        return local(request)
+    except Exception:
+        return {'status': 1, 'error': traceback.format_exc()}
+
+# COMMAND LINE
+################################################################################
+def finish(response):
+    if response.get('output'):
+        print(response['output'], end='')
+    if response.get('html') is not None:
+        print(response['html'])
+    if response.get('error'):
+        print(response['error'], file=sys.stderr)
+    return response.get('status', 1)
+
+def serve_argparse(args):
+    serve(args.socket)
+    return 0
+
+def render_argparse(args):
+    request = {
+        'command': 'render',
+        'md_filename': os.path.abspath(args.md_filename),
+        'css': [os.path.abspath(css) for css in args.css or []],
+        'embed_images': args.do_embed_images,
+        'output_filename': os.path.abspath(args.output_filename) if args.output_filename else None,
+    }
+    return finish(run(args.socket, request, do_render))
+
+def build_argparse(args):
+    request = {'command': 'build', 'argv': args.build_args}
+    return finish(run(args.socket, request, do_build))
+
+def stop_argparse(args):
+    if send(args.socket, {'command': 'stop'}) is None:
+        print(f'No daemon on {args.socket}.')
+        return 1
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', dest='socket', default=None)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p_serve = subparsers.add_parser('serve')
+    p_serve.set_defaults(func=serve_argparse)
+
+    p_render = subparsers.add_parser('render')
+    p_render.add_argument('md_filename')
+    p_render.add_argument('--css', dest='css', action='append', default=None)
+    p_render.add_argument('--embed_images', '--embed-images', dest='do_embed_images', action='store_true')
+    p_render.add_argument('-o', '--output', dest='output_filename', default=None)
+    p_render.set_defaults(func=render_argparse)
+
+    p_build = subparsers.add_parser('build')
+    p_build.add_argument('build_args', nargs=argparse.REMAINDER)
+    p_build.set_defaults(func=build_argparse)
+
+    p_stop = subparsers.add_parser('stop')
+    p_stop.set_defaults(func=stop_argparse)
+
+    args = parser.parse_args(argv)
+    args.socket = args.socket or default_socket()
+    if getattr(args, 'build_args', None) and args.build_args[0] == '--':
+        args.build_args = args.build_args[1:]
+    return args.func(args)
+
+if __name__ == '__main__':
+    raise SystemExit(main(sys.argv[1:]))
@@ -1,24 +1,82 @@
+import argparse
 import bs4
-import etiquette
+import collections
+import contextlib
+import copy
+import datetime
+import email.utils
+import hashlib
 import html
 import jinja2
+import json
 import os
+import posixpath
 import pprint
 import re
 import subprocess
+import sys
+import threading
+import time
+import urllib.parse
 import vmarkdown
 
 from voussoirkit import pathclass
 from voussoirkit import spinal
 from voussoirkit import winwhich
 
-P = etiquette.photodb.PhotoDB(ephemeral=True)
-P.log.setLevel(100)
-
 WRITING_ROOTDIR = pathclass.Path(__file__).parent
 
 GIT = winwhich.which('git')
 
+RELATED_CACHE = WRITING_ROOTDIR.with_child('.related_cache.json')
+# How many related articles to show on each page, and how many candidates to
+# keep in the cache so that an incremental rebuild still has good runners-up
+# when one of the current favorites changes.
+RELATED_SHOW = 3
+RELATED_KEEP = 10
+# The share of the similarity score that comes from tags, the rest is text.
+RELATED_TAG_WEIGHT = 0.5
+RELATED_BATCH_SIZE = 256
+
+# The subscription feeds have this many of the newest articles. Older ones
+# are in archive pages of the same size, per RFC 5005.
+FEED_PAGE_SIZE = 10
+FEED_ARCHIVE_DIR = WRITING_ROOTDIR.with_child('feed_archive')
+
+EXTERNAL_LINK_CACHE = WRITING_ROOTDIR.with_child('.external_link_cache.json')
+# Results younger than this are trusted without asking the server again.
+EXTERNAL_LINK_TTL = 7 * 24 * 3600
+EXTERNAL_LINK_WORKERS = 16
+EXTERNAL_LINK_TIMEOUT = 20
+
+# Files in the writing dir which are part of the generator, not the site.
+BUNDLE_SKIP_EXTENSIONS = {'md', 'py', 'pyc', 'db'}
+BUNDLE_SKIP_NAMES = {'requirements.txt', '__pycache__'}
+
+# The sha256 of every file the build writes, so that later steps don't have
+# to read them back to find out.
+OUTPUT_HASHES = {}
+
+# The most that any one page should weigh, in bytes for each category of
+# page_weight, or in DOM nodes for the keys ending in _nodes. --budget
+# overrides these one at a time.
+WEIGHT_BUDGETS = {
+    'total': 250_000,
+    'total_nodes': 10_000,
+    'css': 20_000,
+    'data_uri_images': 150_000,
+    'code_highlighting': 100_000,
+    'code_highlighting_nodes': 6_000,
+    'commit_history': 20_000,
+}
+
+SERVICE_WORKER_FILE = WRITING_ROOTDIR.with_child('sw.js')
+PRECACHE_MANIFEST_FILE = WRITING_ROOTDIR.with_child('precache.json')
+# Goes in the <head> of every page.
+SERVICE_WORKER_SCRIPT = '''<script>
+if ("serviceWorker" in navigator) {navigator.serviceWorker.register("/writing/sw.js");}
+</script>'''
+
 ARTICLE_TEMPLATE = '''
 [Back to writing](/writing)
 
@@ -34,19 +92,109 @@ ARTICLE_TEMPLATE = '''
 # HELPERS
 ################################################################################
 def check_output(command):
-    return subprocess.check_output(command, stderr=subprocess.PIPE).decode('utf-8')
+    with TRACER.span('subprocess', category='subprocess', command=command[3:]):
+        return subprocess.check_output(command, stderr=subprocess.PIPE).decode('utf-8')
 
-def write(path, content):
+def write(path, content, if_changed=False):
     '''
     open() and write the file, with validation that it is in the writing dir.
+
+    if_changed: If True and the file already has this exact content, it's
+    left alone, so that its mtime, and the Last-Modified and ETag that nginx
+    makes from it, only change when the content does.
     '''
     path = pathclass.Path(path)
     if path not in WRITING_ROOTDIR:
         raise ValueError(path)
+    LINK_INDEX.add_file(path)
+    OUTPUT_HASHES[path.absolute_path] = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    if if_changed and path.is_file and vmarkdown.cat_file(path) == content:
+        return
     print(path.absolute_path)
-    f = path.open('w', encoding='utf-8')
-    f.write(content)
-    f.close()
+    with TRACER.span('write', category='io', path=path.absolute_path, size=len(content)):
+        f = path.open('w', encoding='utf-8')
+        f.write(content)
+        f.close()
+
+def write_cache(path, cache):
+    '''
+    Save one of our json caches. These aren't part of the site, so they skip
+    write() and stay out of the link index, the bundle and the precache.
+    '''
+    with open(pathclass.Path(path).absolute_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, indent=4, sort_keys=True)
+
+# TRACING
+################################################################################
+class Tracer:
+    '''
+    Records nested spans of the build in the Chrome trace event format, which
+    can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+    Each phase also samples tracemalloc at its end, so the trace has a memory
+    counter track showing the current and peak memory of every phase.
+    tracemalloc slows the build down quite a bit, so it's only running while
+    we're tracing.
+    '''
+    def __init__(self):
+        import tracemalloc
+        self.tracemalloc = tracemalloc
+        self.events = []
+        self.pid = os.getpid()
+        self.start = time.perf_counter()
+        tracemalloc.start()
+
+    def now(self):
+        return (time.perf_counter() - self.start) * 1e6
+
+    def _complete(self, name, category, begin, args):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': begin,
+            'dur': self.now() - begin,
+            'pid': self.pid,
+            'tid': threading.get_ident(),
+            'args': args,
+        }
+        self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category='build', **args):
+        begin = self.now()
+        try:
+            yield
+        finally:
+            self._complete(name, category, begin, args)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.tracemalloc.reset_peak()
+        begin = self.now()
+        try:
+            yield
+        finally:
+            (current, peak) = self.tracemalloc.get_traced_memory()
+            memory = {'current_mb': current / 2**20, 'peak_mb': peak / 2**20}
+            self._complete(name, 'phase', begin, memory)
+            counter = {'name': 'memory', 'ph': 'C', 'ts': self.now(), 'pid': self.pid, 'args': memory}
+            self.events.append(counter)
+
+    def dump(self, filename):
+        self.tracemalloc.stop()
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+class NullTracer:
+    def span(self, name, category='build', **args):
+        return contextlib.nullcontext()
+
+    def phase(self, name):
+        return contextlib.nullcontext()
+
+# Replaced by a real Tracer when the build is run with --trace.
+TRACER = NullTracer()
 
 # GIT
 ################################################################################
@@ -179,21 +327,70 @@ def soup_adjust_relative_links(soup, md_file, repo_path):
     fixby('audio', 'src')
     fixby('source', 'src')
 
+def document_body_text(document):
+    '''
+    Return the text of the article itself, leaving out the commit history that
+    ARTICLE_TEMPLATE puts after the final horizontal rule.
+    '''
+    nodes = document.nodes
+    hrules = [index for (index, node) in enumerate(nodes) if node['type'] == 'hrule']
+    if hrules:
+        nodes = nodes[:hrules[-1]]
+    return vmarkdown.render_text(nodes)
+
+def soup_add_related_articles(soup, related):
+    '''
+    Put the list of related articles at the end of the body, right before the
+    <hr> that separates it from the commit history.
+    '''
+    if not related:
+        return
+
+    section = soup.new_tag('section')
+    section['id'] = 'related_articles'
+    header = soup.new_tag('p')
+    header.append('Related articles:')
+    section.append(header)
+    ul = soup.new_tag('ul')
+    for article in related:
+        li = soup.new_tag('li')
+        a = soup.new_tag('a')
+        a['href'] = f'/writing/{article.web_path}'
+        a.append(f'{article.date} - {article.title}')
+        li.append(a)
+        ul.append(li)
+    section.append(ul)
+
+    hrs = soup.article.find_all('hr', recursive=False)
+    if hrs:
+        hrs[-1].insert_before(section)
+    else:
+        soup.article.append(section)
+
+def soup_add_service_worker(soup):
+    script = bs4.BeautifulSoup(SERVICE_WORKER_SCRIPT, 'html.parser')
+    soup.head.append(script)
+
 # ARTICLE
 ################################################################################
 class Article:
     def __init__(self, md_file):
+        with TRACER.span('Article', path=str(md_file)):
+            self._init(md_file)
+
+    def _init(self, md_file):
         self.md_file = pathclass.Path(md_file)
         self.html_file = self.md_file.replace_extension('html')
         self.web_path = self.md_file.parent.relative_to(WRITING_ROOTDIR, simple=True)
-        self.date = git_file_published_date(self.md_file)
-        self.edited = git_file_edited_date(self.md_file)
+        with TRACER.span('git'):
+            self.date = git_file_published_date(self.md_file)
+            self.edited = git_file_edited_date(self.md_file)
 
-        repo_path = git_repo_for_file(self.md_file)
-        relative_path = self.md_file.relative_to(repo_path, simple=True)
-        github_history = f'https://github.com/voussoir/voussoir.net/commits/master/{relative_path}'
+            repo_path = git_repo_for_file(self.md_file)
+            relative_path = self.md_file.relative_to(repo_path, simple=True)
+            github_history = f'https://github.com/voussoir/voussoir.net/commits/master/{relative_path}'
 
-        commits = git_file_commit_history(self.md_file)
+            commits = git_file_commit_history(self.md_file)
         self.publication_id = f'{commits[-1][0]}/{self.web_path}' if commits else None
 
         commits = [
@@ -208,22 +405,207 @@ class Article:
             github_history=github_history,
             commits=commits,
         )
-        self.soup = vmarkdown.markdown(
-            md,
-            css=WRITING_ROOTDIR.with_child('dark.css').absolute_path,
-            return_soup=True,
-        )
-        if self.soup.head.title:
-            self.title = self.soup.head.title.get_text()
-        else:
-            self.title = self.md_file.basename
+        # The metadata comes from the document tree, and markdown() gets the
+        # same tree out of the parse cache to make the html.
+        with TRACER.span('parse'):
+            self.document = vmarkdown.parse(md)
+        with TRACER.span('render'):
+            self.soup = vmarkdown.markdown(
+                md,
+                css=WRITING_ROOTDIR.with_child('dark.css').absolute_path,
+                return_soup=True,
+            )
+        self.title = self.document.title() or self.md_file.basename
+        self.tags = self.document.tags()
+        self.text = document_body_text(self.document)
+        self.in_feeds = has_feed_dates(self)
 
-        self.tags = soup_set_tag_links(self.soup)
+        soup_set_tag_links(self.soup)
         soup_adjust_relative_links(self.soup, self.md_file, repo_path)
+        soup_add_service_worker(self.soup)
+        self.related = []
 
     def __repr__(self):
         return f'Article:{self.title}'
 
+# RELATED ARTICLES
+################################################################################
+def related_words(text):
+    return re.findall(r"[a-z0-9_']{3,}", text.lower())
+
+def related_tags(qualnames):
+    '''
+    An article tagged [tag:python.generators] should also score as related to
+    other articles tagged python, so each qualname brings its parents along.
+    '''
+    tags = set()
+    for qualname in qualnames:
+        parts = qualname.split('.')
+        for index in range(1, len(parts) + 1):
+            tags.add('.'.join(parts[:index]))
+    return tags
+
+def related_fingerprint(article):
+    fingerprint = hashlib.sha256()
+    fingerprint.update(article.text.encode('utf-8'))
+    fingerprint.update('\n'.join(sorted(article.tags)).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+def tfidf_matrix(documents):
+    '''
+    Given a list of term lists, return a csr_matrix with one L2-normalized
+    tf-idf row per document, so that row dot products are cosine similarities.
+    '''
+    import numpy
+    import scipy.sparse
+    vocabulary = {}
+    rows = []
+    columns = []
+    counts = []
+    for (row, terms) in enumerate(documents):
+        for (term, count) in collections.Counter(terms).items():
+            rows.append(row)
+            columns.append(vocabulary.setdefault(term, len(vocabulary)))
+            counts.append(count)
+
+    shape = (len(documents), max(len(vocabulary), 1))
+    tf = numpy.log1p(numpy.array(counts, dtype=numpy.float64))
+    matrix = scipy.sparse.csr_matrix((tf, (rows, columns)), shape=shape)
+
+    document_frequency = numpy.bincount(matrix.indices, minlength=shape[1])
+    idf = numpy.log((1 + shape[0]) / (1 + document_frequency)) + 1
+    matrix = matrix @ scipy.sparse.diags(idf)
+
+    norms = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    matrix = scipy.sparse.diags(1 / norms) @ matrix
+    return matrix.tocsr()
+
+def related_matrix(articles):
+    '''
+    Stack the text and tag tf-idf matrices side by side, each scaled by the
+    square root of its weight, so that one dot product between two rows gives
+    the weighted sum of their text similarity and tag similarity.
+    '''
+    import numpy
+    import scipy.sparse
+    text = tfidf_matrix([related_words(article.text) for article in articles])
+    tags = tfidf_matrix([related_tags(article.tags) for article in articles])
+    matrix = scipy.sparse.hstack([
+        text * numpy.sqrt(1 - RELATED_TAG_WEIGHT),
+        tags * numpy.sqrt(RELATED_TAG_WEIGHT),
+    ])
+    return matrix.tocsr()
+
+def related_top(matrix, rows, columns, keep):
+    '''
+    For each of the given rows, return the `keep` best (column, score) pairs
+    among the given columns. The similarities are computed RELATED_BATCH_SIZE
+    rows at a time so we never hold the whole n*n matrix.
+    '''
+    import numpy
+    results = {}
+    columns = numpy.array(columns, dtype=numpy.int64)
+    if not len(rows) or not len(columns):
+        return results
+
+    right = matrix[columns].T.tocsc()
+    for start in range(0, len(rows), RELATED_BATCH_SIZE):
+        batch = rows[start:start + RELATED_BATCH_SIZE]
+        scores = (matrix[batch] @ right).toarray()
+        # Nobody is related to themselves.
+        scores[numpy.array(batch)[:, None] == columns[None, :]] = 0
+        count = min(keep, len(columns))
+        best = numpy.argpartition(-scores, count - 1, axis=1)[:, :count]
+        best_scores = numpy.take_along_axis(scores, best, axis=1)
+        order = numpy.argsort(-best_scores, axis=1)
+        best = numpy.take_along_axis(best, order, axis=1)
+        best_scores = numpy.take_along_axis(best_scores, order, axis=1)
+        for (row, row_best, row_scores) in zip(batch, best, best_scores):
+            results[row] = [
+                (int(columns[column]), float(score))
+                for (column, score) in zip(row_best, row_scores)
+                if score > 0
+            ]
+    return results
+
+def load_related_cache():
+    if not RELATED_CACHE.exists:
+        return {}
+    try:
+        return json.loads(vmarkdown.cat_file(RELATED_CACHE))
+    except ValueError:
+        return {}
+
+def add_related_articles():
+    '''
+    Find the most related articles for each article and add them to its page.
+
+    Results are cached by a fingerprint of each article's text and tags. Only
+    the articles that changed get their whole row recomputed; the others just
+    get scored against the changed ones and merged with their cached
+    candidates. Scores between two unchanged articles are reused as-is even
+    though the idf weights may have drifted a little in the meantime.
+
+    numpy and scipy are optional. Without them, the pages just don't get a
+    related articles section.
+    '''
+    try:
+        import numpy
+        import scipy.sparse
+    except ImportError:
+        print('numpy and scipy are not installed, skipping related articles.')
+        return
+
+    articles = sorted(ARTICLES.values(), key=lambda a: a.web_path)
+    by_path = {article.web_path: article for article in articles}
+    fingerprints = {article.web_path: related_fingerprint(article) for article in articles}
+
+    cache = load_related_cache()
+    changed = [
+        index for (index, article) in enumerate(articles)
+        if cache.get(article.web_path, {}).get('fingerprint') != fingerprints[article.web_path]
+    ]
+    changed_set = set(changed)
+    unchanged = [index for index in range(len(articles)) if index not in changed_set]
+    stale = {articles[index].web_path for index in changed}
+    stale.update(path for path in cache if path not in by_path)
+
+    results = {}
+    if changed:
+        matrix = related_matrix(articles)
+        everyone = list(range(len(articles)))
+        for (row, top) in related_top(matrix, changed, everyone, RELATED_KEEP).items():
+            results[articles[row].web_path] = [
+                (articles[column].web_path, score) for (column, score) in top
+            ]
+        fresh = related_top(matrix, unchanged, changed, RELATED_KEEP)
+    else:
+        fresh = {}
+
+    for row in unchanged:
+        path = articles[row].web_path
+        candidates = [
+            (other, score) for (other, score) in cache[path]['related']
+            if other not in stale
+        ]
+        candidates.extend(
+            (articles[column].web_path, score) for (column, score) in fresh.get(row, [])
+        )
+        candidates.sort(key=lambda candidate: candidate[1], reverse=True)
+        results[path] = candidates[:RELATED_KEEP]
+
+    for (path, candidates) in results.items():
+        article = by_path[path]
+        article.related = [by_path[other] for (other, score) in candidates[:RELATED_SHOW]]
+        soup_add_related_articles(article.soup, article.related)
+
+    cache = {
+        path: {'fingerprint': fingerprints[path], 'related': candidates}
+        for (path, candidates) in results.items()
+    }
+    write_cache(RELATED_CACHE, cache)
+
 # TAG INDEX
 ################################################################################
 class Index:
@@ -273,7 +655,8 @@ def permute(pool, query=tuple()):
         if complete_tag_index.get(query):
             return
 
-        articles = list(P.search(tag_musts=query))
+        with TRACER.span('P.search', query=[tag.name for tag in query]):
+            articles = list(P.search(tag_musts=query))
         if not articles:
             return
 
@@ -298,6 +681,379 @@ def permute(pool, query=tuple()):
         q = query + (tag,)
         permute(rest, q)
 
+# LINK CHECKING
+################################################################################
+# The elements and attributes which can point at other files on the site.
+LINK_ATTRIBUTES = [
+    ('a', 'href'),
+    ('img', 'src'),
+    ('video', 'src'),
+    ('audio', 'src'),
+    ('source', 'src'),
+]
+
+class LinkIndex:
+    '''
+    Every url path that the site serves, and the element ids on each page, so
+    that checking a link is a couple of set lookups no matter how big the
+    site gets. The build adds each file as it writes it, and the files that
+    are already in the repository (images, other parts of voussoir.net) get
+    added before the check. Outputs left over from earlier builds don't, or
+    links to an article that has since been removed would still resolve.
+    '''
+    def __init__(self, site_root):
+        self.site_root = pathclass.Path(site_root).absolute_path
+        self.paths = set()
+        self.anchors = {}
+
+    def urls_for(self, path):
+        '''
+        Return the url paths which serve this file. Because of the nginx
+        rules, /writing/article is article/article.html, and a folder is its
+        index.html.
+        '''
+        path = pathclass.Path(path).absolute_path
+        url = '/' + os.path.relpath(path, self.site_root).replace(os.sep, '/')
+        urls = [url]
+        (folder, basename) = posixpath.split(url)
+        (stem, extension) = posixpath.splitext(basename)
+        if basename == 'index.html' or (extension == '.html' and stem == posixpath.basename(folder)):
+            urls.append(folder)
+        return urls
+
+    def add_file(self, path):
+        self.paths.update(self.urls_for(path))
+
+    def add_url(self, url):
+        self.paths.add(url)
+
+    def add_anchors(self, path, soup):
+        ids = {element['id'] for element in soup.find_all(id=True)}
+        for url in self.urls_for(path):
+            self.anchors.setdefault(url, set()).update(ids)
+
+    def add_existing_files(self, skip=None):
+        '''
+        skip: A function which takes a path and returns True if that file
+        shouldn't count.
+        '''
+        for (root, dirs, files) in os.walk(self.site_root):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                path = os.path.join(root, name)
+                if skip is None or not skip(path):
+                    self.add_file(path)
+
+    @staticmethod
+    def split(href):
+        (path, _, fragment) = href.partition('#')
+        path = urllib.parse.unquote(path.split('?', 1)[0])
+        if path:
+            path = posixpath.normpath(path)
+        return (path, urllib.parse.unquote(fragment))
+
+    def check(self, href, page_url):
+        '''
+        Return None if the link is fine, or the reason it isn't. Links to other
+        sites aren't our business here.
+        '''
+        if re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:', href) or href.startswith('//'):
+            return None
+        (path, fragment) = self.split(href)
+        path = path or page_url
+        if path not in self.paths:
+            return 'no such page'
+        # Only pages we rendered have known ids. An anchor into anything else
+        # gets the benefit of the doubt.
+        if fragment and path in self.anchors and fragment not in self.anchors[path]:
+            return f'no #{fragment} on {path}'
+        return None
+
+LINK_INDEX = LinkIndex(WRITING_ROOTDIR.parent)
+
+# Files in the writing dir that only the build makes. When they're on disk
+# but weren't written by this build, they're stale.
+GENERATED_EXTENSIONS = {'html', 'atom', 'rss'}
+GENERATED_NAMES = {'sw.js', 'precache.json', 'tags.json'}
+
+def is_generated_output(path):
+    path = pathclass.Path(path)
+    if path not in WRITING_ROOTDIR:
+        return False
+    return path.extension.no_dot in GENERATED_EXTENSIONS or path.basename in GENERATED_NAMES
+
+def check_links():
+    '''
+    Check every internal link, image, video, audio, and source of every
+    article against LINK_INDEX, and print the broken ones. Return the list
+    of (article, href, reason).
+    '''
+    # Everything this build wrote is already in there, so only the sources
+    # and static files need to come off the disk.
+    LINK_INDEX.add_existing_files(skip=is_generated_output)
+    failures = []
+    for article in ARTICLES.values():
+        page_url = LINK_INDEX.urls_for(article.html_file)[-1]
+        for (tagname, attribute) in LINK_ATTRIBUTES:
+            for element in article.soup.find_all(tagname, attrs={attribute: True}):
+                href = element[attribute]
+                reason = LINK_INDEX.check(href, page_url)
+                if reason is not None:
+                    failures.append((article, href, reason))
+
+    for (article, href, reason) in failures:
+        print(f'Broken link in {article.md_file.relative_to(WRITING_ROOTDIR, simple=True)}: {href} ({reason})')
+    if failures:
+        print(f'{len(failures)} broken links.')
+    return failures
+
+def load_external_link_cache():
+    if not EXTERNAL_LINK_CACHE.exists:
+        return {}
+    try:
+        return json.loads(vmarkdown.cat_file(EXTERNAL_LINK_CACHE))
+    except ValueError:
+        return {}
+
+def check_external_link(session, url):
+    '''
+    Return the status code of the url, or the exception text if we couldn't
+    connect at all. Try HEAD first because it's cheap, but plenty of servers
+    answer HEAD with 403 or 405 while serving GET just fine, so any failure
+    gets a second chance as a GET whose body we don't download.
+    '''
+    import requests
+    try:
+        response = session.head(url, allow_redirects=True, timeout=EXTERNAL_LINK_TIMEOUT)
+        if response.status_code < 400:
+            return {'status': response.status_code, 'error': None}
+    except requests.RequestException:
+        pass
+
+    try:
+        with session.get(url, allow_redirects=True, stream=True, timeout=EXTERNAL_LINK_TIMEOUT) as response:
+            return {'status': response.status_code, 'error': None}
+    except requests.RequestException as exc:
+        return {'status': None, 'error': f'{type(exc).__name__}: {exc}'}
+
+def check_external_links(ttl=EXTERNAL_LINK_TTL, workers=EXTERNAL_LINK_WORKERS):
+    '''
+    Check every distinct http(s) link in the articles, on a bounded pool of
+    threads sharing one connection-pooled session, and print the broken ones.
+    Results are saved in EXTERNAL_LINK_CACHE, so a rerun only checks urls
+    whose result is older than `ttl` seconds. Return the list of
+    (url, result, articles) for the broken links.
+    '''
+    import concurrent.futures
+    import requests
+
+    urls = collections.defaultdict(set)
+    for article in ARTICLES.values():
+        for a in article.soup.find_all('a', href=True):
+            href = a['href'].split('#', 1)[0]
+            if href.startswith('http://') or href.startswith('https://'):
+                urls[href].add(article)
+
+    cache = load_external_link_cache()
+    now = time.time()
+    stale = [url for url in urls if now - cache.get(url, {}).get('checked', 0) > ttl]
+    print(f'Checking {len(stale)} of {len(urls)} external links.')
+
+    session = requests.Session()
+    session.headers['User-Agent'] = 'voussoir.net link checker'
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(check_external_link, session, url): url for url in stale}
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            result['checked'] = time.time()
+            cache[futures[future]] = result
+
+    # Links that were removed from every article don't need to be remembered.
+    cache = {url: cache[url] for url in urls}
+    write_cache(EXTERNAL_LINK_CACHE, cache)
+
+    failures = []
+    for (url, articles) in sorted(urls.items()):
+        result = cache[url]
+        if result['status'] is not None and result['status'] < 400:
+            continue
+        failures.append((url, result, articles))
+        problem = result['status'] or result['error']
+        names = ', '.join(sorted(article.md_file.basename for article in articles))
+        print(f'Broken external link {url} ({problem}) in {names}')
+    if failures:
+        print(f'{len(failures)} broken external links.')
+    return failures
+
+# PAGE WEIGHT
+################################################################################
+def weight_categories(soup):
+    '''
+    Return {category: [elements]} for the things that make our pages heavy,
+    in order of precedence.
+    '''
+    categories = {
+        'css': soup.find_all('style'),
+        'data_uri_images': [
+            img for img in soup.find_all('img', src=True)
+            if img['src'].startswith('data:')
+        ],
+        'code_highlighting': soup.find_all('div', class_='highlight'),
+        'commit_history': [],
+    }
+    # The commit history is everything after the last top-level <hr> of an
+    # article, from ARTICLE_TEMPLATE.
+    if soup.article is not None:
+        hrs = soup.article.find_all('hr', recursive=False)
+        if hrs:
+            categories['commit_history'] = hrs[-1].find_next_siblings()
+    return categories
+
+def page_weight(soup, html_text):
+    '''
+    Return {'bytes': {category: n}, 'nodes': {category: n}} for the page,
+    where 'total' is the whole page and 'other' is what's left over.
+
+    Every byte only counts towards the first category it falls under, so an
+    image inside the commit history is an image, and the commit history is
+    the rest of it.
+    '''
+    weight = {'bytes': {}, 'nodes': {}}
+    weight['bytes']['total'] = len(html_text.encode('utf-8'))
+    weight['nodes']['total'] = len(soup.find_all(True))
+    # id(element) -> (bytes, nodes) for the elements counted so far.
+    counted = {}
+    for (category, elements) in weight_categories(soup).items():
+        (category_bytes, category_nodes) = (0, 0)
+        for element in elements:
+            if id(element) in counted or any(id(parent) in counted for parent in element.parents):
+                continue
+            descendants = element.find_all(True)
+            element_bytes = len(str(element).encode('utf-8'))
+            element_nodes = 1 + len(descendants)
+            # Take out what an earlier category already has.
+            for descendant in descendants:
+                inner = counted.get(id(descendant))
+                if inner is not None:
+                    element_bytes -= inner[0]
+                    element_nodes -= inner[1]
+            counted[id(element)] = (element_bytes, element_nodes)
+            category_bytes += element_bytes
+            category_nodes += element_nodes
+        weight['bytes'][category] = category_bytes
+        weight['nodes'][category] = category_nodes
+    for key in ('bytes', 'nodes'):
+        weight[key]['other'] = weight[key]['total'] - sum(
+            value for (category, value) in weight[key].items() if category != 'total'
+        )
+    return weight
+
+def over_budget(weight, budgets):
+    '''
+    Return a list of (budget, limit, value) for each budget this page is over.
+    '''
+    failures = []
+    for (budget, limit) in budgets.items():
+        if budget.endswith('_nodes'):
+            value = weight['nodes'].get(budget[:-len('_nodes')], 0)
+        else:
+            value = weight['bytes'].get(budget, 0)
+        if value > limit:
+            failures.append((budget, limit, value))
+    return failures
+
+def parse_budgets(budget_args):
+    budgets = dict(WEIGHT_BUDGETS)
+    for budget_arg in budget_args or []:
+        (name, _, limit) = budget_arg.partition('=')
+        if name not in budgets:
+            raise ValueError(f'Unknown budget {name}, should be one of {sorted(budgets)}.')
+        budgets[name] = int(limit.replace('_', ''))
+    return budgets
+
+def weigh_pages(budgets, report_file=None):
+    '''
+    Weigh every html page the build wrote, print the heaviest ones and the
+    ones over budget, and write the report as json if report_file is given.
+    Return the list of (url, budget, limit, value) that were over.
+
+    Articles are weighed from the soup they were rendered from, the other
+    pages have to be parsed from what was written.
+    '''
+    soups = {article.html_file.absolute_path: article.soup for article in ARTICLES.values()}
+    pages = {}
+    failures = []
+    for path in sorted(OUTPUT_HASHES):
+        if not path.endswith('.html'):
+            continue
+        url = LINK_INDEX.urls_for(path)[-1]
+        with TRACER.span('weigh', path=path):
+            soup = soups.get(path)
+            if soup is None:
+                html_text = vmarkdown.cat_file(path)
+                soup = bs4.BeautifulSoup(html_text, 'html.parser')
+            else:
+                html_text = str(soup)
+            weight = page_weight(soup, html_text)
+        pages[url] = weight
+        for (budget, limit, value) in over_budget(weight, budgets):
+            failures.append((url, budget, limit, value))
+
+    heaviest = sorted(pages.items(), key=lambda item: item[1]['bytes']['total'], reverse=True)
+    for (url, weight) in heaviest[:10]:
+        parts = ', '.join(
+            f'{category} {value:,}'
+            for (category, value) in weight['bytes'].items()
+            if value and category != 'total'
+        )
+        print(f'{weight["bytes"]["total"]:>9,} bytes {weight["nodes"]["total"]:>6,} nodes {url} ({parts})')
+
+    for (url, budget, limit, value) in failures:
+        print(f'Over budget: {url} {budget} is {value:,}, limit {limit:,}.')
+
+    if report_file is not None:
+        report = {
+            'generated': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'budgets': budgets,
+            'pages': pages,
+            'over_budget': [
+                {'url': url, 'budget': budget, 'limit': limit, 'value': value}
+                for (url, budget, limit, value) in failures
+            ],
+        }
+        with open(report_file, 'w', encoding='utf-8') as handle:
+            json.dump(report, handle, indent=4, sort_keys=True)
+
+    return failures
+
+# SITE BUNDLE
+################################################################################
+def bundle_files():
+    '''
+    Yield (url, path) for every file of the writing section of the site,
+    under each url nginx would serve it at.
+    '''
+    for (root, dirs, files) in os.walk(WRITING_ROOTDIR.absolute_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d not in BUNDLE_SKIP_NAMES)
+        for name in sorted(files):
+            if name.startswith('.') or name in BUNDLE_SKIP_NAMES:
+                continue
+            if name.rpartition('.')[2] in BUNDLE_SKIP_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            for url in LINK_INDEX.urls_for(path):
+                yield (url, path)
+
+def write_bundle(filename):
+    import site_bundle
+    changes = site_bundle.update_bundle(filename, bundle_files())
+    counts = ', '.join(f'{len(urls)} {key}' for (key, urls) in changes.items())
+    print(f'Bundled into {filename}: {counts}.')
+
 # RENDER FILES
 ################################################################################
 def write_articles():
@@ -311,6 +1067,7 @@ def write_articles():
         P.new_photo(article.md_file.absolute_path, tags=article.tags)
         html = str(article.soup)
         write(article.html_file.absolute_path, html)
+        LINK_INDEX.add_anchors(article.html_file, article.soup)
 
 def make_tag_page(index, path):
     path = [tag.name for tag in path]
@@ -324,6 +1081,7 @@ def make_tag_page(index, path):
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0"/>
     <link rel="stylesheet" href="/writing/dark.css"/>
+    {{service_worker}}
     {% if path %}
     <title>Articles tagged {{path}}</title>
     {% else %}
@@ -380,9 +1138,38 @@ def make_tag_page(index, path):
         articles=sorted(index.articles, key=lambda a: a.date, reverse=True),
         path=path,
         children=sorted(tag.name for tag in index.children.keys()),
+        service_worker=SERVICE_WORKER_SCRIPT,
     )
     return page
 
+def remove_tag_output(dynamic):
+    '''
+    Delete the tag output of the mode we aren't building in. The static tag
+    pages would override the dynamic shell through nginx's try_files, and a
+    leftover tags.json is just stale.
+    '''
+    tags_dir = WRITING_ROOTDIR.with_child('tags')
+    if not tags_dir.is_dir:
+        return
+    if not dynamic:
+        tags_json = tags_dir.with_child('tags.json')
+        if tags_json.is_file:
+            print(f'Removing {tags_json.absolute_path}')
+            os.remove(tags_json.absolute_path)
+        return
+
+    # The shell is tags/index.html, only the pages of the subtags go.
+    for (root, dirs, files) in os.walk(tags_dir.absolute_path, topdown=False):
+        if root == tags_dir.absolute_path:
+            continue
+        for name in files:
+            if name == 'index.html':
+                path = os.path.join(root, name)
+                print(f'Removing {path}')
+                os.remove(path)
+        if not os.listdir(root):
+            os.rmdir(root)
+
 def write_tag_pages(index, path=[]):
     for (child_name, child_index) in index.children.items():
         write_tag_pages(child_index, path=path+[child_name])
@@ -392,9 +1179,272 @@ def write_tag_pages(index, path=[]):
     filepath = WRITING_ROOTDIR.join(filepath)
     filepath.parent.makedirs(exist_ok=True)
 
-    page = make_tag_page(index, path)
+    with TRACER.span('tag page', path=[tag.name for tag in path]):
+        page = make_tag_page(index, path)
+        write(filepath, page)
+
+def make_tag_index_json():
+    '''
+    Instead of writing a page for every node of the complete_tag_index, we can
+    write one file mapping each tag to the sorted ids of its articles and let
+    the browser do the intersections. Article ids are positions in the
+    date-sorted article list, so any intersection is already in display order.
+    '''
+    articles = sorted(ARTICLES.values(), key=lambda a: a.date, reverse=True)
+    article_ids = {article: index for (index, article) in enumerate(articles)}
+
+    tags = {}
+    for tag in P.get_tags():
+        results = [ARTICLES[photo.real_path] for photo in P.search(tag_musts=(tag,))]
+        tags[tag.name] = {
+            'parents': sorted(parent.name for parent in tag.walk_parents()),
+            'articles': sorted(article_ids[article] for article in results),
+        }
+
+    articles = [
+        {'web_path': article.web_path, 'date': article.date, 'title': article.title}
+        for article in articles
+    ]
+    index = {'articles': articles, 'tags': tags}
+    return json.dumps(index, separators=(',', ':'), sort_keys=True)
+
+def write_tag_index_json():
+    filepath = WRITING_ROOTDIR.join(os.sep.join(['tags', 'tags.json']))
+    filepath.parent.makedirs(exist_ok=True)
+    write(filepath, make_tag_index_json())
+
+    # The tag shell answers for every tag url, so as far as links are
+    # concerned they all exist.
+    for tag in P.get_tags():
+        LINK_INDEX.add_url(f'/writing/tags/{tag.name}')
+
+def make_tag_shell():
+    '''
+    This page is served for /writing/tags and every /writing/tags/a/b below
+    it, which requires nginx to fall back to it, like:
+    location /writing/tags { try_files $uri /writing/tags/index.html; }
+    The page reads the query from the url, follows the same rules as permute
+    to decide which refinements are worth showing, and uses history routing so
+    clicking around doesn't reload the page.
+    '''
+    page = jinja2.Template('''
+    <html>
+    <head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0"/>
+    <link rel="stylesheet" href="/writing/dark.css"/>
+    {{service_worker}}
+    <title>Articles by tag</title>
+    </head>
+    <body>
+    <article>
+    <section style="grid-area:tagnav">
+    <p><a href="/writing">Back to writing</a></p>
+    <a id="back_link" href="/writing/tags">Back to tags</a>
+    </section>
+
+    <section id="articles_section" style="grid-area:articles">
+    <h1 id="articles_header"></h1>
+    <ol id="articles_list" class="article_list"></ol>
+    </section>
+
+    <section id="refine_section" style="grid-area:refine">
+    <h1>Refine your query</h1>
+    <ul id="refine_list" class="article_list"></ul>
+    </section>
+    </article>
+    </body>
+
+    <script type="text/javascript">
+    const TAGS_ROOT = "/writing/tags";
+    let INDEX = null;
+
+    function intersect(a, b)
+    {
+        // Both arrays are sorted, so this is a linear merge.
+        const result = [];
+        let i = 0;
+        let j = 0;
+        while (i < a.length && j < b.length)
+        {
+            if (a[i] === b[j])
+            {
+                result.push(a[i]);
+                i += 1;
+                j += 1;
+            }
+            else if (a[i] < b[j])
+            {
+                i += 1;
+            }
+            else
+            {
+                j += 1;
+            }
+        }
+        return result;
+    }
+
+    function same_results(a, b)
+    {
+        return a.length === b.length && a.every((value, index) => value === b[index]);
+    }
+
+    function remove_redundant(query)
+    {
+        const seen = new Set();
+        const newq = [];
+        for (const tag of query)
+        {
+            if (seen.has(tag))
+            {
+                continue;
+            }
+            newq.push(tag);
+            seen.add(tag);
+            for (const parent of INDEX.tags[tag].parents)
+            {
+                seen.add(parent);
+            }
+        }
+        return newq;
+    }
+
+    function search(query)
+    {
+        if (query.length === 0)
+        {
+            return [];
+        }
+        let results = INDEX.tags[query[0]].articles;
+        for (const tag of query.slice(1))
+        {
+            results = intersect(results, INDEX.tags[tag].articles);
+        }
+        return results;
+    }
 
-    write(filepath, page)
+    function refinements(query, results)
+    {
+        const children = [];
+        for (const tag of Object.keys(INDEX.tags).sort())
+        {
+            const refined = remove_redundant(query.concat([tag]));
+            if (refined.length === query.length)
+            {
+                continue;
+            }
+            const refined_results = search(refined);
+            if (refined_results.length === 0)
+            {
+                continue;
+            }
+            if (query.length > 0 && same_results(refined_results, results))
+            {
+                continue;
+            }
+            children.push(tag);
+        }
+        return children;
+    }
+
+    function make_li(href, text)
+    {
+        const li = document.createElement("li");
+        const a = document.createElement("a");
+        a.href = href;
+        a.innerText = text;
+        li.appendChild(a);
+        return li;
+    }
+
+    function render()
+    {
+        let path = window.location.pathname.slice(TAGS_ROOT.length);
+        path = path.split("/").filter(part => part !== "");
+        path = path.filter(tag => tag in INDEX.tags);
+        const query = remove_redundant(path);
+        const results = search(query);
+        const children = refinements(query, results);
+
+        const back_link = document.getElementById("back_link");
+        const parent = path.slice(0, -1).join("/");
+        if (parent)
+        {
+            back_link.href = `${TAGS_ROOT}/${parent}`;
+            back_link.innerText = `Back to ${parent}`;
+        }
+        else
+        {
+            back_link.href = TAGS_ROOT;
+            back_link.innerText = "Back to tags";
+        }
+
+        const joined = path.join("/");
+        document.title = joined ? `Articles tagged ${joined}` : "Articles by tag";
+
+        const articles_section = document.getElementById("articles_section");
+        const articles_list = document.getElementById("articles_list");
+        articles_list.innerHTML = "";
+        articles_section.hidden = results.length === 0;
+        document.getElementById("articles_header").innerText = joined;
+        for (const id of results)
+        {
+            const article = INDEX.articles[id];
+            const text = `${article.date} - ${article.title}`;
+            articles_list.appendChild(make_li(`/writing/${article.web_path}`, text));
+        }
+
+        const refine_section = document.getElementById("refine_section");
+        const refine_list = document.getElementById("refine_list");
+        refine_list.innerHTML = "";
+        refine_section.hidden = children.length === 0;
+        for (const tag of children)
+        {
+            const href = joined ? `${TAGS_ROOT}/${joined}/${tag}` : `${TAGS_ROOT}/${tag}`;
+            refine_list.appendChild(make_li(href, tag));
+        }
+    }
+
+    function on_click(event)
+    {
+        const a = event.target.closest("a");
+        if (! a || event.ctrlKey || event.metaKey || event.shiftKey)
+        {
+            return;
+        }
+        const url = new URL(a.href);
+        if (url.origin !== window.location.origin || ! url.pathname.startsWith(TAGS_ROOT))
+        {
+            return;
+        }
+        event.preventDefault();
+        window.history.pushState(null, "", url.pathname);
+        render();
+    }
+
+    function on_pageload()
+    {
+        fetch(`${TAGS_ROOT}/tags.json`)
+        .then(response => response.json())
+        .then(index =>
+        {
+            INDEX = index;
+            render();
+            document.addEventListener("click", on_click);
+            window.addEventListener("popstate", render);
+        });
+    }
+    document.addEventListener("DOMContentLoaded", on_pageload);
+    </script>
+    </html>
+    ''').render(service_worker=SERVICE_WORKER_SCRIPT)
+    return page
+
+def write_tag_shell():
+    filepath = WRITING_ROOTDIR.join(os.sep.join(['tags', 'index.html']))
+    filepath.parent.makedirs(exist_ok=True)
+    write(filepath, make_tag_shell())
 
 def write_writing_index():
     page = jinja2.Template('''
@@ -405,6 +1455,7 @@ def write_writing_index():
     <link rel="stylesheet" href="/writing/dark.css"/>
     <link rel="alternate" type="application/atom+xml" href="/writing/writing.atom"/>
     <link rel="alternate" type="application/rss+xml" href="/writing/writing.rss"/>
+    {{service_worker}}
     <title>Writing</title>
     </head>
 
@@ -446,81 +1497,479 @@ def write_writing_index():
     </html>
     ''').render(
         articles=sorted(ARTICLES.values(), key=lambda a: a.date, reverse=True),
-        articles_edited=sorted(ARTICLES.values(), key=lambda a: a.edited, reverse=True)
+        articles_edited=sorted(ARTICLES.values(), key=lambda a: a.edited, reverse=True),
+        service_worker=SERVICE_WORKER_SCRIPT,
     )
     write(WRITING_ROOTDIR.with_child('index.html'), page)
 
-def write_atom():
-    latest_date = max(article.date for article in ARTICLES_PUBLISHED.values())
+def feed_datetime(date):
+    '''
+    Our dates are YYYY-MM-DD strings from git, but feeds want full timestamps.
+    When git gives several lines, like --diff-filter=A for a file that was
+    added more than once, the first one is used.
+
+    Raises ValueError if there's no date to be found.
+    '''
+    lines = date.strip().splitlines()
+    if not lines:
+        raise ValueError(f'Empty date {date!r}.')
+    return datetime.datetime.strptime(lines[0].strip(), '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
+
+def has_feed_dates(article):
+    try:
+        feed_datetime(article.date)
+        if article.edited:
+            feed_datetime(article.edited)
+    except ValueError as exc:
+        print(f'Warning: Leaving {article} out of the feeds, bad date: {exc}')
+        return False
+    return True
+
+def feed_content(article):
+    '''
+    The article as it goes in the feeds, without the related articles or the
+    commit history, which change whenever other articles are published, and
+    would change the archive pages that are supposed to stay put.
+    '''
+    content = copy.copy(article.soup.article)
+    related = content.find(id='related_articles', recursive=False)
+    if related is not None:
+        related.decompose()
+    hrs = content.find_all('hr', recursive=False)
+    if hrs:
+        for sibling in hrs[-1].find_next_siblings():
+            sibling.decompose()
+        hrs[-1].decompose()
+    return content
+
+def atom_date(date):
+    return feed_datetime(date).isoformat()
+
+def rss_date(date):
+    return email.utils.format_datetime(feed_datetime(date))
+
+def feed_pages():
+    '''
+    Return the articles of the subscription feed, newest first, and the list
+    of archive pages, each a list of articles oldest first.
+
+    Archive page n always holds the same FEED_PAGE_SIZE articles in order of
+    publication, and a page isn't made until it's full, so publishing a new
+    article never changes an existing archive page. Editing an article only
+    changes the one page it's on. The subscription feed is the newest
+    FEED_PAGE_SIZE articles, which overlaps with the newest archive page, but
+    readers merge entries by id anyway.
+    '''
+    articles = [article for article in ARTICLES_PUBLISHED.values() if article.in_feeds]
+    articles.sort(key=lambda a: (a.date, a.publication_id))
+    full_pages = len(articles) // FEED_PAGE_SIZE
+    archives = [
+        articles[index * FEED_PAGE_SIZE:(index + 1) * FEED_PAGE_SIZE]
+        for index in range(full_pages)
+    ]
+    current = articles[-FEED_PAGE_SIZE:][::-1]
+    return (current, archives)
+
+def feed_links(extension, page_number, archive_count):
+    '''
+    The RFC 5005 links for the subscription feed (page_number None) or an
+    archive page (page_number 1 through archive_count).
+    '''
+    base = 'https://voussoir.net/writing'
+    current = f'{base}/writing.{extension}'
+    archive = lambda number: f'{base}/feed_archive/{number}.{extension}'
+    if page_number is None:
+        links = {'self': current}
+        if archive_count:
+            links['prev-archive'] = archive(archive_count)
+        return links
+    links = {'self': archive(page_number), 'current': current}
+    if page_number > 1:
+        links['prev-archive'] = archive(page_number - 1)
+    if page_number < archive_count:
+        links['next-archive'] = archive(page_number + 1)
+    return links
+
+def make_atom(articles, links, is_archive):
+    latest_date = max(article.edited or article.date for article in articles)
     atom = jinja2.Template('''
     <?xml version="1.0" encoding="utf-8"?>
-    <feed xmlns="http://www.w3.org/2005/Atom">
+    <feed xmlns="http://www.w3.org/2005/Atom" xmlns:fh="http://purl.org/syndication/history/1.0">
         <title>voussoir.net/writing</title>
         <link href="https://voussoir.net/writing"/>
+        {% for (rel, href) in links.items() %}
+        <link rel="{{rel}}" href="{{href}}"/>
+        {% endfor %}
+        {% if is_archive %}
+        <fh:archive/>
+        {% endif %}
         <id>voussoir.net/writing</id>
-        <updated>{{latest_date}}</updated>
+        <updated>{{atom_date(latest_date)}}</updated>
 
         {% for article in articles %}
         <entry>
             <id>{{article.publication_id}}</id>
             <title>{{article.title|e}}</title>
             <link rel="alternate" href="https://voussoir.net/writing/{{article.web_path}}"/>
-            <updated>{{article.date}}</updated>
+            <published>{{atom_date(article.date)}}</published>
+            <updated>{{atom_date(article.edited or article.date)}}</updated>
             <content type="html">
             <![CDATA[
-            {{article.soup.article}}
+            {{feed_content(article)}}
             ]]>
             </content>
         </entry>
         {% endfor %}
     </feed>
     '''.strip()).render(
-        articles=sorted(ARTICLES_PUBLISHED.values(), key=lambda a: a.date, reverse=True),
+        articles=articles,
+        links=links,
+        is_archive=is_archive,
         latest_date=latest_date,
+        atom_date=atom_date,
+        feed_content=feed_content,
     )
-    write(WRITING_ROOTDIR.with_child('writing.atom'), atom)
+    return atom
 
-def write_rss():
+def make_rss(articles, links, is_archive):
     rss = jinja2.Template('''
-    <rss version="2.0">
+    <rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom" xmlns:fh="http://purl.org/syndication/history/1.0">
     <channel>
         <title>voussoir.net/writing</title>
         <link>https://voussoir.net/writing</link>
         <description>voussoir's writing</description>
+        {% for (rel, href) in links.items() %}
+        <atom:link rel="{{rel}}" href="{{href}}"/>
+        {% endfor %}
+        {% if is_archive %}
+        <fh:archive/>
+        {% endif %}
 
         {% for article in articles %}
         <item>
             <title>{{article.title|e}}</title>
             <guid isPermalink="false">{{article.publication_id}}</guid>
             <link>https://voussoir.net/writing/{{article.web_path}}</link>
-            <pubDate>{{article.date}}</pubDate>
+            <pubDate>{{rss_date(article.date)}}</pubDate>
+            <atom:updated>{{atom_date(article.edited or article.date)}}</atom:updated>
             <description>
             <![CDATA[
-            {{article.soup.article}}
+            {{feed_content(article)}}
             ]]>
             </description>
         </item>
         {% endfor %}
     </channel>
     </rss>
-    '''.strip()).render(articles=sorted(ARTICLES_PUBLISHED.values(), key=lambda a: a.date, reverse=True))
-    write(WRITING_ROOTDIR.with_child('writing.rss'), rss)
+    '''.strip()).render(
+        articles=articles,
+        links=links,
+        is_archive=is_archive,
+        rss_date=rss_date,
+        atom_date=atom_date,
+        feed_content=feed_content,
+    )
+    return rss
+
+def write_feeds(extension, make_feed):
+    (current, archives) = feed_pages()
+    if archives:
+        FEED_ARCHIVE_DIR.makedirs(exist_ok=True)
+    for (index, articles) in enumerate(archives):
+        number = index + 1
+        with TRACER.span('feed archive', extension=extension, number=number):
+            feed = make_feed(articles, feed_links(extension, number, len(archives)), is_archive=True)
+            write(FEED_ARCHIVE_DIR.with_child(f'{number}.{extension}'), feed, if_changed=True)
+    # Feed readers poll, so an unchanged feed should keep answering them 304.
+    feed = make_feed(current, feed_links(extension, None, len(archives)), is_archive=False)
+    write(WRITING_ROOTDIR.with_child(f'writing.{extension}'), feed, if_changed=True)
+
+def write_atom():
+    write_feeds('atom', make_atom)
+
+def write_rss():
+    write_feeds('rss', make_rss)
 
-# GO
+# SERVICE WORKER
 ################################################################################
-ARTICLES = {
-    file: Article(file)
-    for file in spinal.walk_generator(WRITING_ROOTDIR)
-    if file.extension == 'md' and file.parent != WRITING_ROOTDIR
+SERVICE_WORKER_TEMPLATE = r"""
+// Generated by generate_site.py. The manifest changes whenever one of the
+// precached files does, which changes this file, which makes browsers
+// install the new version.
+const VERSION = "{{version}}";
+const MANIFEST = {{manifest}};
+const PRECACHE = "precache-" + VERSION;
+const RUNTIME = "runtime";
+// The runtime cache only keeps pages, and only this many of the most
+// recently fetched ones, so it can't fill up the reader's device.
+const RUNTIME_LIMIT = 50;
+
+function precache_key(url)
+{
+    return url + "?rev=" + MANIFEST[url];
+}
+
+function manifest_url(pathname)
+{
+    // The index is precached as /writing/, articles without the slash.
+    if (pathname in MANIFEST)
+    {
+        return pathname;
+    }
+    const trimmed = pathname.replace(/\/+$/, "");
+    return (trimmed in MANIFEST) ? trimmed : null;
+}
+
+async function precache_one(cache, url)
+{
+    // Files that haven't changed since the last version are copied out of
+    // the old precache instead of being downloaded again.
+    const key = precache_key(url);
+    const old = await caches.match(key);
+    if (old)
+    {
+        return cache.put(key, old);
+    }
+    const response = await fetch(url, {"cache": "no-cache"});
+    if (response.status !== 200)
+    {
+        throw new Error(`Precaching ${url} failed with ${response.status}.`);
+    }
+    return cache.put(key, response);
+}
+
+self.addEventListener("install", function(event)
+{
+    event.waitUntil((async function()
+    {
+        const cache = await caches.open(PRECACHE);
+        await Promise.all(Object.keys(MANIFEST).map(url => precache_one(cache, url)));
+        await self.skipWaiting();
+    })());
+});
+
+self.addEventListener("activate", function(event)
+{
+    event.waitUntil((async function()
+    {
+        for (const name of await caches.keys())
+        {
+            if (name !== PRECACHE && name !== RUNTIME)
+            {
+                await caches.delete(name);
+            }
+        }
+        await self.clients.claim();
+    })());
+});
+
+async function trim_runtime(cache)
+{
+    // Keys come back in the order they were added, oldest first.
+    const keys = await cache.keys();
+    for (const key of keys.slice(0, Math.max(0, keys.length - RUNTIME_LIMIT)))
+    {
+        await cache.delete(key);
+    }
+}
+
+async function stale_while_revalidate(event)
+{
+    const cache = await caches.open(RUNTIME);
+    const cached = await cache.match(event.request);
+    const fresh = fetch(event.request);
+    const update = fresh.then(async function(response)
+    {
+        if (response.status === 200)
+        {
+            await cache.put(event.request, response.clone());
+            await trim_runtime(cache);
+        }
+    }).catch(() => null);
+    event.waitUntil(update);
+    if (cached)
+    {
+        return cached;
+    }
+    return fresh;
 }
 
-ARTICLES_PUBLISHED = {file: article for (file, article) in ARTICLES.items() if article.publication_id}
+self.addEventListener("fetch", function(event)
+{
+    const request = event.request;
+    const url = new URL(request.url);
+    if (request.method !== "GET" || url.origin !== self.location.origin)
+    {
+        return;
+    }
+    // Seeking in audio and video needs the server's partial responses.
+    if (request.headers.has("Range"))
+    {
+        return;
+    }
+    const precached = manifest_url(url.pathname);
+    if (precached !== null)
+    {
+        event.respondWith(caches.match(precache_key(precached)).then(cached => cached || fetch(request)));
+        return;
+    }
+    // Images, media, and everything else go straight to the network, only
+    // pages are kept for offline reading.
+    if (request.mode === "navigate" || request.destination === "document")
+    {
+        event.respondWith(stale_while_revalidate(event));
+    }
+});
+"""
+
+def output_hash(path):
+    '''
+    Return the sha256 of a file, from OUTPUT_HASHES if the build wrote it.
+    '''
+    path = pathclass.Path(path)
+    sha256 = OUTPUT_HASHES.get(path.absolute_path)
+    if sha256 is None:
+        with path.open('rb') as handle:
+            sha256 = hashlib.sha256(handle.read()).hexdigest()
+        OUTPUT_HASHES[path.absolute_path] = sha256
+    return sha256
+
+def make_precache_manifest():
+    '''
+    Return {url: sha256} for the files that every visitor should have
+    offline: the css, the writing index, the articles in the subscription
+    feed, and the feeds themselves.
+    '''
+    (current, archives) = feed_pages()
+    files = [
+        WRITING_ROOTDIR.with_child('dark.css'),
+        WRITING_ROOTDIR.with_child('index.html'),
+        WRITING_ROOTDIR.with_child('writing.atom'),
+        WRITING_ROOTDIR.with_child('writing.rss'),
+    ]
+    files.extend(article.html_file for article in current)
+    # The last url is the prettiest one, like /writing/article for
+    # /writing/article/article.html.
+    manifest = {LINK_INDEX.urls_for(file)[-1]: output_hash(file) for file in files}
+    # The worker's scope is /writing/, which doesn't include /writing itself,
+    # so the index has to be reached as /writing/ to be served offline.
+    manifest['/writing/'] = manifest.pop('/writing')
+    return manifest
+
+def write_service_worker():
+    manifest = make_precache_manifest()
+    manifest_json = json.dumps(manifest, indent=4, sort_keys=True)
+    version = hashlib.sha256(manifest_json.encode('utf-8')).hexdigest()[:16]
+    write(PRECACHE_MANIFEST_FILE, json.dumps({'version': version, 'files': manifest}, indent=4, sort_keys=True))
+    service_worker = jinja2.Template(SERVICE_WORKER_TEMPLATE).render(version=version, manifest=manifest_json)
+    write(SERVICE_WORKER_FILE, service_worker.lstrip())
+
+# COMMAND LINE
+################################################################################
+def generate_site_argparse(args):
+    global TRACER
+    # Set it both ways, because a build daemon runs many builds in one process.
+    TRACER = Tracer() if args.trace else NullTracer()
+    try:
+        return build(args)
+    finally:
+        if args.trace:
+            TRACER.dump(args.trace)
+        TRACER = NullTracer()
+
+def build(args):
+    global ARTICLES
+    global ARTICLES_PUBLISHED
+    global P
+    global complete_tag_index
+    global LINK_INDEX
+
+    LINK_INDEX = LinkIndex(WRITING_ROOTDIR.parent)
+    OUTPUT_HASHES.clear()
+    # Check these before spending the whole build to find out they're wrong.
+    budgets = parse_budgets(args.budgets)
+
+    # etiquette and its PhotoDB are only needed for an actual build, so they
+    # are not loaded for --help.
+    with TRACER.phase('photodb'):
+        import etiquette
+        P = etiquette.photodb.PhotoDB(ephemeral=True)
+        P.log.setLevel(100)
+
+    with TRACER.phase('articles'):
+        ARTICLES = {
+            file: Article(file)
+            for file in spinal.walk_generator(WRITING_ROOTDIR)
+            if file.extension == 'md' and file.parent != WRITING_ROOTDIR
+        }
+
+    ARTICLES_PUBLISHED = {file: article for (file, article) in ARTICLES.items() if article.publication_id}
+
+    with TRACER.phase('related'):
+        add_related_articles()
+
+    with TRACER.phase('write_articles'):
+        write_articles()
+
+    remove_tag_output(dynamic=args.dynamic_tags)
+    if args.dynamic_tags:
+        with TRACER.phase('tag_index'):
+            write_tag_index_json()
+            write_tag_shell()
+    else:
+        complete_tag_index = Index()
+        all_tags = set(P.get_tags())
+        with TRACER.phase('permute'):
+            permute(all_tags)
+        with TRACER.phase('write_tag_pages'):
+            write_tag_pages(complete_tag_index)
+
+    with TRACER.phase('writing_index'):
+        write_writing_index()
+
+    with TRACER.phase('feeds'):
+        write_atom()
+        write_rss()
+
+    with TRACER.phase('service_worker'):
+        write_service_worker()
+
+    with TRACER.phase('check_links'):
+        check_links()
+
+    if args.check_external_links:
+        with TRACER.phase('check_external_links'):
+            check_external_links()
+
+    budget_failures = []
+    if args.weight_report or args.budgets or args.fail_over_budget:
+        with TRACER.phase('page_weight'):
+            budget_failures = weigh_pages(budgets, report_file=args.weight_report)
+
+    if budget_failures and args.fail_over_budget:
+        print(f'{len(budget_failures)} budgets exceeded, not bundling.')
+        return 1
+
+    if args.bundle:
+        with TRACER.phase('bundle'):
+            write_bundle(args.bundle)
+
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dynamic_tags', '--dynamic-tags', dest='dynamic_tags', action='store_true')
+    parser.add_argument('--check_external_links', '--check-external-links', dest='check_external_links', action='store_true')
+    parser.add_argument('--trace', dest='trace', default=None)
+    parser.add_argument('--bundle', dest='bundle', default=None)
+    parser.add_argument('--weight_report', '--weight-report', dest='weight_report', default=None)
+    parser.add_argument('--budget', dest='budgets', action='append', default=None)
+    parser.add_argument('--fail_over_budget', '--fail-over-budget', dest='fail_over_budget', action='store_true')
+    parser.set_defaults(func=generate_site_argparse)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
 
-write_articles()
-complete_tag_index = Index()
-all_tags = set(P.get_tags())
-permute(all_tags)
-write_tag_pages(complete_tag_index)
-write_writing_index()
-write_atom()
-write_rss()
+if __name__ == '__main__':
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,318 @@
+'''
+The whole generated site in one SQLite file, so that deploying is copying
+one file instead of syncing thousands of little ones, and a tiny WSGI app
+that serves straight out of it.
+
+    generate_site.py --bundle site.db
+    site_bundle.py serve site.db --port 8000
+    site_bundle.py diff deployed.db site.db
+
+The files table maps each url path to the sha256 of its content, and the
+blobs table holds each distinct content once, along with its gzipped form
+when that's smaller. Both are keyed by their primary key WITHOUT ROWID, so
+serving a request is one lookup in each b-tree, and comparing two bundles is
+comparing their hashes.
+
+Updating a bundle only reads and compresses the files whose hash isn't
+already in it, and the update is one transaction, so a server reading the
+same file sees either the old site or the new one.
+'''
+import argparse
+import gzip
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blobs(
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    content BLOB NOT NULL,
+    gzip BLOB
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS files(
+    url TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    mimetype TEXT NOT NULL,
+    mtime_ns INTEGER,
+    size INTEGER
+) WITHOUT ROWID;
+'''
+
+# Files smaller than this aren't worth the gzip header.
+GZIP_MIN_SIZE = 256
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/atom+xml',
+    'application/javascript',
+    'application/json',
+    'application/rss+xml',
+    'application/sql',
+    'application/xml',
+    'image/svg+xml',
+}
+
+# The mimetypes module doesn't know the feeds.
+FEED_MIMETYPES = {
+    '.atom': 'application/atom+xml',
+    '.rss': 'application/rss+xml',
+}
+
+def content_type(filename):
+    '''
+    Return the Content-Type to serve the file with, with the charset for
+    text.
+    '''
+    import vmarkdown
+    extension = os.path.splitext(filename)[1].lower()
+    mimetype = (
+        FEED_MIMETYPES.get(extension) or
+        vmarkdown.guess_mimetype(filename) or
+        'application/octet-stream'
+    )
+    if mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIMETYPES:
+        mimetype += '; charset=utf-8'
+    return mimetype
+
+def is_compressible(mimetype):
+    mimetype = mimetype.split(';')[0]
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIMETYPES
+
+def sha256_file(filename):
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(2**20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def connect(filename, readonly=False):
+    if readonly:
+        uri = 'file:' + os.path.abspath(filename) + '?mode=ro'
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+    sql = sqlite3.connect(filename)
+    sql.executescript(SCHEMA)
+    return sql
+
+# BUNDLING
+################################################################################
+def update_bundle(filename, files):
+    '''
+    Make the bundle at `filename` serve exactly these files.
+
+    files: An iterable of (url, path) pairs. The same path can be served
+    under several urls, and its content is only stored once.
+
+    Files are hashed from their bytes on disk, so the ETag always matches
+    what nginx would serve, but only again if their mtime or size changed
+    since the last bundle.
+
+    Returns a dict of {'added', 'changed', 'removed'} url lists.
+    '''
+    sql = connect(filename)
+    try:
+        previous = {
+            url: (sha256, mtime_ns, size)
+            for (url, sha256, mtime_ns, size) in sql.execute('SELECT url, sha256, mtime_ns, size FROM files')
+        }
+        have_blobs = {sha256 for (sha256,) in sql.execute('SELECT sha256 FROM blobs')}
+        changes = {'added': [], 'changed': [], 'removed': []}
+        urls = set()
+        # A path served under several urls only needs hashing once.
+        hashes = {}
+
+        with sql:
+            for (url, path) in files:
+                urls.add(url)
+                stat = os.stat(path)
+                old = previous.get(url)
+                if old is not None and old[1:] == (stat.st_mtime_ns, stat.st_size):
+                    sha256 = old[0]
+                elif path in hashes:
+                    sha256 = hashes[path]
+                else:
+                    sha256 = sha256_file(path)
+                hashes[path] = sha256
+
+                mimetype = content_type(path)
+                if sha256 not in have_blobs:
+                    with open(path, 'rb') as handle:
+                        content = handle.read()
+                    compressed = None
+                    if is_compressible(mimetype) and len(content) >= GZIP_MIN_SIZE:
+                        # mtime=0 so the same content always gzips the same.
+                        compressed = gzip.compress(content, mtime=0)
+                        if len(compressed) >= len(content):
+                            compressed = None
+                    sql.execute(
+                        'INSERT INTO blobs(sha256, size, content, gzip) VALUES(?, ?, ?, ?)',
+                        [sha256, len(content), content, compressed],
+                    )
+                    have_blobs.add(sha256)
+
+                old = previous.get(url)
+                if old is None:
+                    changes['added'].append(url)
+                elif old[0] != sha256:
+                    changes['changed'].append(url)
+                sql.execute(
+                    'INSERT OR REPLACE INTO files(url, sha256, mimetype, mtime_ns, size) VALUES(?, ?, ?, ?, ?)',
+                    [url, sha256, mimetype, stat.st_mtime_ns, stat.st_size],
+                )
+
+            for url in previous.keys() - urls:
+                sql.execute('DELETE FROM files WHERE url = ?', [url])
+                changes['removed'].append(url)
+            sql.execute('DELETE FROM blobs WHERE sha256 NOT IN (SELECT sha256 FROM files)')
+    finally:
+        sql.close()
+
+    for key in changes:
+        changes[key].sort()
+    return changes
+
+def diff_bundles(old_filename, new_filename):
+    '''
+    Compare two bundles by their hashes and return a dict of
+    {'added', 'changed', 'removed'} url lists.
+    '''
+    def hashes(filename):
+        sql = connect(filename, readonly=True)
+        try:
+            return dict(sql.execute('SELECT url, sha256 FROM files'))
+        finally:
+            sql.close()
+
+    old = hashes(old_filename)
+    new = hashes(new_filename)
+    return {
+        'added': sorted(new.keys() - old.keys()),
+        'changed': sorted(url for url in new.keys() & old.keys() if new[url] != old[url]),
+        'removed': sorted(old.keys() - new.keys()),
+    }
+
+# SERVING
+################################################################################
+LOOKUP = '''
+SELECT files.sha256, files.mimetype, blobs.content, blobs.gzip
+FROM files JOIN blobs ON blobs.sha256 = files.sha256
+WHERE files.url = ?
+'''
+
+# With --dynamic_tags, every tag url is the same shell page which reads the
+# tag out of the location, like nginx's try_files does for the live site.
+TAG_SHELL_URL = '/writing/tags'
+
+def etag_matches(if_none_match, etag):
+    '''
+    Whether the If-None-Match header, which can be a list of etags, some of
+    them weak, or *, matches our etag.
+    '''
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+class BundleApp:
+    '''
+    A WSGI app which serves the bundle, with gzip when the client accepts it
+    and the hash as the ETag, falling back to the tag shell for tag urls that
+    have no page. Each thread gets its own read-only connection.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+
+    def lookup(self, url):
+        sql = getattr(self.local, 'sql', None)
+        if sql is None:
+            sql = connect(self.filename, readonly=True)
+            self.local.sql = sql
+        return sql.execute(LOOKUP, [url]).fetchone()
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        if method not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Allow', 'GET, HEAD')])
+            return [b'']
+
+        url = environ.get('PATH_INFO') or '/'
+        if url != '/':
+            url = url.rstrip('/')
+        row = self.lookup(url)
+        if row is None and url.startswith(TAG_SHELL_URL + '/'):
+            row = self.lookup(TAG_SHELL_URL)
+        if row is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain; charset=utf-8')])
+            return [b'404 Not Found']
+
+        (sha256, mimetype, content, compressed) = row
+        use_gzip = compressed is not None and 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')
+        # The two bodies are different bytes, so they need different etags.
+        etag = f'"{sha256}-gzip"' if use_gzip else f'"{sha256}"'
+        headers = [('ETag', etag), ('Vary', 'Accept-Encoding')]
+        if etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+            start_response('304 Not Modified', headers)
+            return [b'']
+
+        headers.append(('Content-Type', mimetype))
+        if use_gzip:
+            content = compressed
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(content))))
+        start_response('200 OK', headers)
+        if method == 'HEAD':
+            return [b'']
+        return [content]
+
+# COMMAND LINE
+################################################################################
+def serve_argparse(args):
+    import socketserver
+    import wsgiref.simple_server
+
+    class ThreadingWSGIServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+        daemon_threads = True
+
+    app = BundleApp(args.bundle)
+    server = wsgiref.simple_server.make_server(args.host, args.port, app, server_class=ThreadingWSGIServer)
+    print(f'Serving {args.bundle} on http://{args.host}:{args.port}.')
+    server.serve_forever()
+    return 0
+
+def diff_argparse(args):
+    changes = diff_bundles(args.old, args.new)
+    for (key, symbol) in [('added', '+'), ('changed', '*'), ('removed', '-')]:
+        for url in changes[key]:
+            print(symbol, url)
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p_serve = subparsers.add_parser('serve')
+    p_serve.add_argument('bundle')
+    p_serve.add_argument('--host', dest='host', default='127.0.0.1')
+    p_serve.add_argument('--port', dest='port', type=int, default=8000)
+    p_serve.set_defaults(func=serve_argparse)
+
+    p_diff = subparsers.add_parser('diff')
+    p_diff.add_argument('old')
+    p_diff.add_argument('new')
+    p_diff.set_defaults(func=diff_argparse)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    raise SystemExit(main(sys.argv[1:]))
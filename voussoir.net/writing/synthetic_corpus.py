@@ -0,0 +1,337 @@
+'''
+Build throwaway git repositories full of synthetic articles, so we can watch
+how generate_site scales before the real site grows into its problems.
+
+The repository looks like this one: a writing folder containing a copy of
+generate_site.py, vmarkdown.py and dark.css, and one folder per article. Each
+article has hierarchical [tag:a.b.c] tags, headers, code blocks, footnotes, a
+local image, and a history of several commits, some of them [minor].
+'''
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+from voussoirkit import winwhich
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GIT = winwhich.which('git')
+
+# The files that a synthetic writing folder needs in order to build.
+SITE_FILES = ['generate_site.py', 'vmarkdown.py', 'dark.css']
+
+# The smallest valid PNG, 1x1 transparent.
+TINY_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c4'
+    '890000000d4944415478da63f8ffff3f0005fe02fea7d6a4510000000049454e'
+    '44ae426082'
+)
+
+WORDS = '''
+about after again against almost along already although always among another
+answer around because become before begin behind believe between both bring
+build cause change check choose clear close common consider could create data
+decide different during early enough every example explain fact feel file
+follow force function general group happen happy hardware history idea
+important include instead interest issue keep kind language large later learn
+leave least little local machine maybe might minute money move music network
+never notice number often order other paper people perhaps person place point
+possible power problem process program public question quite rather reason
+remember result right school second server simple since small software
+something sound start still story student system thing think though through
+today together under until value video village water while window without
+wonder world write wrong year
+'''.split()
+
+CODE_LANGS = {
+    'python': 'def {name}(items):\n    total = 0\n    for item in items:\n        total += len(item)\n    return total\n',
+    'bash': 'for file in *.{name}; do\n    echo "$file"\ndone\n',
+    'html': '<div class="{name}">\n    <p>Hello</p>\n</div>\n',
+    '': 'plain {name} text\n    indented\n',
+}
+
+# GENERATION
+################################################################################
+def make_tags(count, rng, depth=3, branching=4):
+    '''
+    Return `count` tag qualnames like a.b.c, built as a tree so that tags share
+    their parents the way real ones do.
+    '''
+    tags = []
+    frontier = ['']
+    while len(tags) < count:
+        parent = frontier.pop(0)
+        for x in range(branching):
+            name = rng.choice(WORDS) + str(len(tags))
+            qualname = f'{parent}.{name}' if parent else name
+            tags.append(qualname)
+            if qualname.count('.') < depth - 1:
+                frontier.append(qualname)
+            if len(tags) == count:
+                break
+        if not frontier:
+            frontier = ['']
+    return tags
+
+def make_sentence(rng):
+    words = [rng.choice(WORDS) for x in range(rng.randint(6, 20))]
+    return ' '.join(words).capitalize() + '.'
+
+def make_paragraph(rng, footnotes):
+    sentences = [make_sentence(rng) for x in range(rng.randint(2, 6))]
+    if rng.random() < 0.3:
+        sentences.insert(rng.randrange(len(sentences)), '[footnote_link]')
+        footnotes.append(make_sentence(rng))
+    return ' '.join(sentences)
+
+def make_article(name, tags, rng, revision=0):
+    '''
+    Return the markdown for one article. Different revisions of the same
+    article share their structure but not all of their words, so that the
+    commit history has real diffs.
+    '''
+    footnotes = []
+    lines = [' '.join(f'[tag:{tag}]' for tag in tags), '', f'{name.replace("_", " ").title()}', '=' * 20, '']
+    for section in range(rng.randint(2, 5)):
+        lines.extend([f'## {make_sentence(rng)[:-1]}', ''])
+        for x in range(rng.randint(1, 4)):
+            lines.extend([make_paragraph(rng, footnotes), ''])
+        if rng.random() < 0.5:
+            (lang, code) = rng.choice(list(CODE_LANGS.items()))
+            lines.extend([f'```{lang}', code.format(name=rng.choice(WORDS)), '```', ''])
+        if section == 0:
+            lines.extend(['![](diagram.png)', ''])
+    lines.extend([f'Revision {revision}.', ''])
+    for footnote in footnotes:
+        lines.extend([f'[footnote_text] {footnote}', ''])
+    return '\n'.join(lines)
+
+def git(repo, *args, date=None):
+    env = dict(os.environ)
+    if date is not None:
+        stamp = date.strftime('%Y-%m-%dT12:00:00')
+        env['GIT_AUTHOR_DATE'] = stamp
+        env['GIT_COMMITTER_DATE'] = stamp
+    command = [GIT, '-C', repo, *args]
+    subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+
+def generate_corpus(directory, articles, tags, commits=4, tags_per_article=3, seed=0):
+    '''
+    Create a git repository at `directory` with `articles` synthetic articles
+    using `tags` distinct tags. The history is `commits` rounds: the first
+    round publishes everything, and every later round edits a random quarter
+    of the articles, sometimes as a [minor] commit.
+    '''
+    if os.path.exists(directory):
+        raise ValueError(f'{directory} already exists.')
+    rng = random.Random(seed)
+    writing = os.path.join(directory, 'writing')
+    os.makedirs(writing)
+    for filename in SITE_FILES:
+        shutil.copy(os.path.join(HERE, filename), writing)
+
+    git(directory, 'init', '--quiet')
+    git(directory, 'config', 'user.name', 'synthetic')
+    git(directory, 'config', 'user.email', 'synthetic@localhost')
+
+    all_tags = make_tags(tags, rng)
+    names = [f'synthetic_{x:06d}' for x in range(articles)]
+    article_tags = {
+        name: rng.sample(all_tags, min(tags_per_article, len(all_tags)))
+        for name in names
+    }
+    seeds = {name: rng.random() for name in names}
+
+    def write_article(name, revision):
+        folder = os.path.join(writing, name)
+        os.makedirs(folder, exist_ok=True)
+        md = make_article(name, article_tags[name], random.Random(seeds[name] + revision), revision)
+        with open(os.path.join(folder, f'{name}.md'), 'w', encoding='utf-8') as f:
+            f.write(md)
+        with open(os.path.join(folder, 'diagram.png'), 'wb') as f:
+            f.write(TINY_PNG)
+
+    date = datetime.date(2015, 1, 1)
+    for name in names:
+        write_article(name, 0)
+    git(directory, 'add', '.')
+    git(directory, 'commit', '--quiet', '-m', 'Publish synthetic articles.', date=date)
+
+    revisions = dict.fromkeys(names, 0)
+    for round in range(1, commits):
+        date += datetime.timedelta(days=rng.randint(1, 60))
+        edited = rng.sample(names, max(1, len(names) // 4))
+        for name in edited:
+            revisions[name] += 1
+            write_article(name, revisions[name])
+        minor = '[minor] ' if rng.random() < 0.3 else ''
+        git(directory, 'add', '.')
+        git(directory, 'commit', '--quiet', '-m', f'{minor}Edit round {round}.', date=date)
+
+    print(f'Generated {articles} articles with {tags} tags in {directory}.')
+    return writing
+
+# SCALING
+################################################################################
+def run_build(writing, extra_args=[]):
+    '''
+    Run generate_site in the synthetic writing folder and return its wall
+    time, peak RSS in megabytes, and the phase durations from its trace.
+    The peak RSS is None where there's no os.wait4, like on Windows.
+    '''
+    trace = os.path.join(writing, 'trace.json')
+    command = [sys.executable, os.path.join(writing, 'generate_site.py'), '--trace', trace, *extra_args]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=writing, stdout=subprocess.DEVNULL)
+    if hasattr(os, 'wait4'):
+        # wait4 gives the rusage of this one child, where
+        # getrusage(RUSAGE_CHILDREN) would give the largest of all children so far.
+        (pid, status, rusage) = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is kilobytes on Linux but bytes on Mac.
+        scale = 2**20 if sys.platform == 'darwin' else 2**10
+        peak_mb = rusage.ru_maxrss / scale
+    else:
+        process.wait()
+        peak_mb = None
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+    with open(trace, 'r', encoding='utf-8') as f:
+        events = json.load(f)['traceEvents']
+    phases = {
+        event['name']: {'seconds': event['dur'] / 1e6, 'peak_mb': event['args']['peak_mb']}
+        for event in events
+        if event.get('cat') == 'phase'
+    }
+    return {'seconds': elapsed, 'peak_mb': peak_mb, 'phases': phases}
+
+def scale_test(directory, sizes, tag_ratio, commits, seed, extra_args=[]):
+    '''
+    Generate a corpus and build it at every size. Tags grow with the corpus,
+    `tag_ratio` tags for every article, because a fixed tag count would
+    hide the cost of permute.
+    '''
+    results = []
+    for size in sizes:
+        tags = max(1, int(size * tag_ratio))
+        writing = generate_corpus(
+            os.path.join(directory, str(size)),
+            articles=size,
+            tags=tags,
+            commits=commits,
+            seed=seed,
+        )
+        result = run_build(writing, extra_args)
+        result.update(articles=size, tags=tags)
+        results.append(result)
+        peak = 'n/a' if result['peak_mb'] is None else f'{result["peak_mb"]:.1f}MB'
+        print(f'{size:>7} articles {tags:>6} tags {result["seconds"]:>9.2f}s {peak:>10}')
+    return results
+
+def growth_exponents(results, key='seconds'):
+    '''
+    The exponent k in time ~ articles^k between each pair of neighboring sizes.
+    1 is linear, 2 is quadratic, and anything that keeps rising is worse.
+    '''
+    import math
+    exponents = []
+    for (before, after) in zip(results, results[1:]):
+        ratio = after[key] / before[key] if before[key] else float('inf')
+        exponent = math.log(ratio) / math.log(after['articles'] / before['articles'])
+        exponents.append((before['articles'], after['articles'], exponent))
+    return exponents
+
+def plot_results(results, filename):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('matplotlib is not installed, skipping the plot.')
+        return
+
+    sizes = [result['articles'] for result in results]
+    (figure, (time_axis, memory_axis)) = plt.subplots(1, 2, figsize=(12, 5))
+
+    phases = sorted({phase for result in results for phase in result['phases']})
+    time_axis.plot(sizes, [result['seconds'] for result in results], marker='o', label='total')
+    for phase in phases:
+        seconds = [result['phases'].get(phase, {}).get('seconds', 0) for result in results]
+        time_axis.plot(sizes, seconds, marker='.', label=phase)
+    time_axis.set(xscale='log', yscale='log', xlabel='articles', ylabel='seconds', title='Build time')
+    time_axis.legend(fontsize='small')
+
+    memory_axis.plot(sizes, [result['peak_mb'] or float('nan') for result in results], marker='o')
+    memory_axis.set(xscale='log', xlabel='articles', ylabel='MB', title='Peak RSS')
+
+    figure.tight_layout()
+    figure.savefig(filename)
+    print(f'Wrote {filename}.')
+
+# COMMAND LINE
+################################################################################
+def generate_argparse(args):
+    generate_corpus(
+        args.directory,
+        articles=args.articles,
+        tags=args.tags,
+        commits=args.commits,
+        seed=args.seed,
+    )
+    return 0
+
+def scale_argparse(args):
+    extra_args = ['--dynamic_tags'] if args.dynamic_tags else []
+    results = scale_test(
+        args.directory,
+        sizes=args.sizes,
+        tag_ratio=args.tag_ratio,
+        commits=args.commits,
+        seed=args.seed,
+        extra_args=extra_args,
+    )
+    for (before, after, exponent) in growth_exponents(results):
+        print(f'{before:>7} -> {after:<7} time ~ n^{exponent:.2f}')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+    if args.plot:
+        plot_results(results, args.plot)
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p_generate = subparsers.add_parser('generate')
+    p_generate.add_argument('directory')
+    p_generate.add_argument('--articles', dest='articles', type=int, default=100)
+    p_generate.add_argument('--tags', dest='tags', type=int, default=30)
+    p_generate.add_argument('--commits', dest='commits', type=int, default=4)
+    p_generate.add_argument('--seed', dest='seed', type=int, default=0)
+    p_generate.set_defaults(func=generate_argparse)
+
+    p_scale = subparsers.add_parser('scale')
+    p_scale.add_argument('directory')
+    p_scale.add_argument('--sizes', dest='sizes', nargs='+', type=int, default=[10, 20, 40, 80])
+    p_scale.add_argument('--tag_ratio', '--tag-ratio', dest='tag_ratio', type=float, default=0.3)
+    p_scale.add_argument('--commits', dest='commits', type=int, default=4)
+    p_scale.add_argument('--seed', dest='seed', type=int, default=0)
+    p_scale.add_argument('--dynamic_tags', '--dynamic-tags', dest='dynamic_tags', action='store_true')
+    p_scale.add_argument('--output', '-o', dest='output', default=None)
+    p_scale.add_argument('--plot', dest='plot', default=None)
+    p_scale.set_defaults(func=scale_argparse)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,66 @@
+'''
+python -m unittest test_vmarkdown
+'''
+import base64
+import os
+import re
+import tempfile
+import unittest
+
+import vmarkdown
+
+class ImageTest(unittest.TestCase):
+    '''
+    Two documents in their own folders, each with its own graph.svg, rendered
+    in one batch that shares an image cache.
+    '''
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = self.tempdir.name
+        self.md_filenames = []
+        self.svgs = {}
+        for name in ['first', 'second']:
+            folder = os.path.join(self.root, name)
+            os.makedirs(folder)
+            svg = f'<svg xmlns="http://www.w3.org/2000/svg"><text>{name}</text></svg>'.encode('utf-8')
+            with open(os.path.join(folder, 'graph.svg'), 'wb') as f:
+                f.write(svg)
+            md_filename = os.path.join(folder, f'{name}.md')
+            with open(md_filename, 'w', encoding='utf-8') as f:
+                f.write(f'# {name}\n\n![graph](graph.svg)\n')
+            self.md_filenames.append(md_filename)
+            self.svgs[name] = svg
+
+        # The relative srcs must not depend on where we're running from.
+        self.previous_cwd = os.getcwd()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.previous_cwd)
+        self.tempdir.cleanup()
+
+    def output(self, name):
+        with open(os.path.join(self.root, 'output', f'{name}.html'), encoding='utf-8') as f:
+            return f.read()
+
+    def test_embed_images_same_relative_src(self):
+        vmarkdown.markdown_batch(self.md_filenames, os.path.join(self.root, 'output'), do_embed_images=True)
+        for name in ['first', 'second']:
+            match = re.search(r'src="data:image/svg\+xml;base64,([^"]+)"', self.output(name))
+            self.assertIsNotNone(match)
+            self.assertEqual(base64.b64decode(match.group(1)), self.svgs[name])
+
+    def test_fingerprint_images_same_relative_src(self):
+        assets_dir = os.path.join(self.root, 'output', 'assets')
+        vmarkdown.markdown_batch(self.md_filenames, os.path.join(self.root, 'output'), assets_dir=assets_dir, assets_url='assets')
+        srcs = {}
+        for name in ['first', 'second']:
+            match = re.search(r'src="assets/(graph\.[0-9a-f]+\.svg)"', self.output(name))
+            self.assertIsNotNone(match)
+            with open(os.path.join(assets_dir, match.group(1)), 'rb') as f:
+                self.assertEqual(f.read(), self.svgs[name])
+            srcs[name] = match.group(1)
+        self.assertNotEqual(srcs['first'], srcs['second'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,24 +1,30 @@
 import argparse
 import base64
 import bs4
+import collections
+import contextlib
 import copy
+import datetime
+import functools
+import gzip
+import hashlib
 import html
-import mimetypes
+import html.parser
+import json
 import mistune
 import os
-import pygments
-import pygments.formatters
-import pygments.lexers
-import pygments.token
 import re
-import regex
-import requests
 import string
+import struct
 import sys
+import threading
+import time
 import traceback
+import urllib.parse
 import warnings
 
 from voussoirkit import pathclass
+from voussoirkit import winglob
 
 HTML_TEMPLATE = '''
 <html>
@@ -41,11 +47,61 @@ HTML_TEMPLATE = '''
 
 SLUG_CHARACTERS = string.ascii_lowercase + string.digits + '_'
 
-session = requests.Session()
+# Added to pages served by markdown_flask with ?refresh. The server holds the
+# event stream open until the markdown or css changes, then the page fetches
+# itself and swaps in the new <head> and <article> without losing its scroll
+# position. The token identifies the version of the files that the page was
+# rendered from, so a change that lands before the stream connects is not
+# missed.
+LIVE_RELOAD_SCRIPT = '''
+<script>
+(function()
+{{
+    let token = "{token}";
+    let source = null;
+
+    function on_change(event)
+    {{
+        token = event.data;
+        source.close();
+        fetch(window.location.pathname)
+        .then(response => response.text())
+        .then(text =>
+        {{
+            const new_document = new DOMParser().parseFromString(text, "text/html");
+            document.head.innerHTML = new_document.head.innerHTML;
+            document.querySelector("article").replaceWith(new_document.querySelector("article"));
+        }})
+        .finally(connect);
+    }}
+
+    function connect()
+    {{
+        source = new EventSource(`${{window.location.pathname}}?events=${{token}}`);
+        source.addEventListener("change", on_change);
+    }}
+
+    connect();
+}})();
+</script>
+'''.strip()
+
+# The heavier imports like pygments, requests, and flask are deferred until
+# the first time they're actually needed, so that rendering a simple document
+# or printing --help doesn't pay for all of them. See benchmark_vmarkdown.py
+# importtime.
+_session = None
+def get_session():
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+    return _session
 
 
 class SyntaxHighlighting:
     def block_code(self, text, lang):
+        _profile.count('code_blocks')
         inlinestyles = self.options.get('inlinestyles') or False
         linenos = self.options.get('linenos') or False
         return self._block_code(text, lang, inlinestyles, linenos)
@@ -56,6 +112,9 @@ class SyntaxHighlighting:
             text = text.strip()
             text = re.sub(r'^((?: {4})*) {1,2}([^\s]|$)', r'\1\2', text, flags=re.MULTILINE)
             return f'<pre><code>{mistune.escape(text)}</code></pre>\n'
+        import pygments.lexers
+        import pygments.token
+        _profile.count('pygments_lexes')
         try:
             lexer = pygments.lexers.get_lexer_by_name(lang.lower(), stripall=True)
             # if isinstance(lexer, pygments.lexers.PythonLexer):
@@ -114,7 +173,142 @@ class VoussoirRenderer(
         SyntaxHighlighting,
         mistune.Renderer,
     ):
-    pass
+    # The renderer methods for VoussoirInline's own rules. They go through the
+    # renderer like mistune's rules do so that TreeRenderer sees them too.
+    def category_tag(self, qualname):
+        tagname = qualname.split('.')[-1]
+        return f'<a class="tag_link" data-qualname="{qualname}">[{tagname}]</a>'
+
+    def footnote_link(self, index):
+        return f'<a id="footnote_link_{index}" class="footnote_link" href="#footnote_text_{index}" data-index={index}>[{index}]</a>'
+
+    def footnote_text(self, index):
+        return f'<a id="footnote_text_{index}" class="footnote_text" href="#footnote_link_{index}" data-index={index}>[{index}]</a>'
+
+    def entity(self, name):
+        return f'&{name};'
+
+    def supers(self, carets, text):
+        return f'{"<sup>" * carets}{text}{"</sup>" * carets}'
+
+    def reddit_link(self, path):
+        return f'<a href="https://old.reddit.com{path}">{path}</a>'
+
+# The characters that each inline rule's match can begin with. At each
+# position, VoussoirInline only tries the rules whose trigger includes the
+# current character, plus the rules that aren't listed here (namely `text`),
+# in their usual order. When you add a rule, add its triggers here and the
+# `text` lookahead will pick them up too.
+INLINE_TRIGGERS = {
+    'redditor': '/',
+    'subreddit': '/',
+    'footnote_text': '[',
+    'footnote_link': '[',
+    'supers_many': '^',
+    'supers_one': '^',
+    'category_tag': '[',
+    'rarr': '-',
+    'larr': '<',
+    'mdash': '-',
+    'escape': '\\',
+    'inline_html': '<',
+    'autolink': '<',
+    'url': 'h',
+    'footnote': '[',
+    'link': '![',
+    'reflink': '![',
+    'nolink': '![',
+    'double_emphasis': '_*',
+    'emphasis': '_*',
+    'code': '`',
+    'linebreak': ' ',
+    'strikethrough': '~',
+}
+
+# `url` and `linebreak` have their own lookaheads in the `text` rule since
+# their trigger characters are far too common to stop on.
+_TEXT_STOPS = sorted({
+    char
+    for (rule, chars) in INLINE_TRIGGERS.items()
+    if rule not in ('url', 'linebreak')
+    for char in chars
+})
+_TEXT_STOPS = re.escape(''.join(_TEXT_STOPS))
+
+class SupersManyPattern:
+    '''
+    Matches ^(text) where the text may contain balanced parentheses of its
+    own, like ^(see (this) one), with the same groups that a regex would have:
+    group 1 is the carets and group 2 is the text.
+
+    This used to be a recursive pattern from the `regex` module, which could
+    backtrack for a very long time on paragraphs with unbalanced parentheses.
+    Instead, we pair up all of the parens in one pass with a stack.
+
+    The inline lexer calls match on the remainder of the paragraph after each
+    token, so every text we get is a suffix of the previous one until the next
+    paragraph starts. By recording the pairs as distances from the end of the
+    text, one table serves all of those suffixes and a paragraph full of ^(
+    doesn't get rescanned for each of them.
+
+    Rendering the inside of a ^(...), or of emphasis or a link, calls match
+    on that inner text, which isn't a suffix of the paragraph. So the lexer
+    does every output inside of `nested()`, which gives each level of text
+    its own table on top of a stack and throws it away afterwards. That way
+    the outer lexer picks up where it left off with its table intact,
+    instead of rescanning the paragraph for every token after the first
+    nested ^(. The stack is per thread since the grammar is shared by every
+    renderer.
+    '''
+    opener = re.compile(r'\^+\(')
+    parens = re.compile(r'[()]')
+    groups = re.compile(r'(\^+)\(([\s\S]*)\)')
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _tables(self):
+        tables = getattr(self._local, 'tables', None)
+        if tables is None:
+            tables = self._local.tables = [('', {})]
+        return tables
+
+    @contextlib.contextmanager
+    def nested(self):
+        tables = self._tables()
+        tables.append(('', {}))
+        try:
+            yield
+        finally:
+            tables.pop()
+
+    def _closers(self, text):
+        tables = self._tables()
+        (cached_text, closers) = tables[-1]
+        if len(text) <= len(cached_text) and cached_text.endswith(text):
+            return closers
+
+        closers = {}
+        stack = []
+        length = len(text)
+        for paren in self.parens.finditer(text):
+            if paren.group(0) == '(':
+                stack.append(length - paren.start())
+            elif stack:
+                closers[stack.pop()] = length - paren.start()
+        tables[-1] = (text, closers)
+        return closers
+
+    def match(self, text):
+        opener = self.opener.match(text)
+        if not opener:
+            return None
+
+        closers = self._closers(text)
+        close = closers.get(len(text) - opener.end() + 1)
+        if close is None:
+            return None
+        return self.groups.fullmatch(text, 0, len(text) - close + 1)
 
 class VoussoirInlineGrammar(mistune.InlineGrammar):
     larr = re.compile(r'<--')
@@ -122,19 +316,16 @@ class VoussoirInlineGrammar(mistune.InlineGrammar):
     mdash = re.compile(r'--')
     category_tag = re.compile(r'\[tag:([\w\.]+)\]')
     supers_one = re.compile(r'(\^+)([^\s\(]+)')
-    _not_parens = r'[^()]+'
-    _paren_pair = r'\(.+?\)'
-    _supered = rf'(?:{_not_parens}|{_paren_pair}|(?1))'
-    supers_many = regex.compile(rf'(?V1)(\^+)\(({_supered}*)\)')
+    supers_many = SupersManyPattern()
     footnote_link = re.compile(r'\[footnote_link\]')
     footnote_text = re.compile(r'\[footnote_text\]')
     subreddit = re.compile(r'\/r\/[A-Za-z0-9_]+')
     redditor = re.compile(r'\/u\/[A-Za-z0-9_]+')
     # This `text` override is based on this article:
     # https://ana-balica.github.io/2015/12/21/mistune-custom-lexers-we-are-going-deeper/
-    # in which we have to keep adding characters to the recognized list every
-    # time we make a new rule. My additions so far are \- and \^.
-    text = re.compile(r'^[\s\S]+?(?=[\\<!\[_*`~\-\^\/]|https?:\/\/| {2,}\n|$)')
+    # in which we have to stop the text at every character that might begin
+    # some other rule, otherwise that rule would never get a chance to match.
+    text = re.compile(rf'^[\s\S]+?(?=[{_TEXT_STOPS}]|https?:\/\/| {{2,}}\n|$)')
 
 class VoussoirInline(mistune.InlineLexer):
     default_rules = copy.copy(mistune.InlineLexer.default_rules)
@@ -152,38 +343,104 @@ class VoussoirInline(mistune.InlineLexer):
     def __init__(self, renderer, **kwargs):
         rules = VoussoirInlineGrammar()
         super().__init__(renderer, rules, **kwargs)
+        self._dispatch_tables = {}
+
+    def _dispatch_table(self, rules):
+        '''
+        Return ({char: [(name, match, output), ...]}, anywhere) for the given
+        list of rule names, where `anywhere` are the rules to try for any
+        character that isn't in the dict. The order of the original list is
+        preserved within each entry, so we get the same results as trying
+        every rule in turn.
+        '''
+        key = tuple(rules)
+        table = self._dispatch_tables.get(key)
+        if table is not None:
+            return table
+
+        def resolve(names):
+            return [
+                (name, getattr(self.rules, name).match, getattr(self, f'output_{name}'))
+                for name in names
+            ]
+
+        chars = {char for rule in rules for char in INLINE_TRIGGERS.get(rule, '')}
+        by_char = {
+            char: resolve(
+                rule for rule in rules
+                if rule not in INLINE_TRIGGERS or char in INLINE_TRIGGERS[rule]
+            )
+            for char in chars
+        }
+        anywhere = resolve(rule for rule in rules if rule not in INLINE_TRIGGERS)
+        table = (by_char, anywhere)
+        self._dispatch_tables[key] = table
+        return table
+
+    def output(self, text, rules=None):
+        '''
+        Same as mistune.InlineLexer.output, except that at each position we
+        only try the rules which are able to match the current character.
+        '''
+        text = text.rstrip('\n')
+        if not rules:
+            rules = self.default_rules
+
+        if self._in_footnote and 'footnote' in rules:
+            rules = [rule for rule in rules if rule != 'footnote']
+
+        (by_char, anywhere) = self._dispatch_table(rules)
+        output = self.renderer.placeholder()
+        _profile.count('inline_lexer_calls')
+
+        # Text inside emphasis, links and supers gets its own closers table,
+        # see SupersManyPattern.
+        with self.rules.supers_many.nested():
+            while text:
+                for (name, match, render) in by_char.get(text[0], anywhere):
+                    m = match(text)
+                    if not m:
+                        continue
+                    self.line_match = m
+                    out = render(m)
+                    if out is not None:
+                        break
+                else:
+                    raise RuntimeError(f'Infinite loop at: {text}')
+                output += out
+                text = text[len(m.group(0)):]
+
+        return output
 
     def output_category_tag(self, m):
-        qualname = m.group(1)
-        tagname = qualname.split('.')[-1]
-        return f'<a class="tag_link" data-qualname="{qualname}">[{tagname}]</a>'
+        return self.renderer.category_tag(m.group(1))
 
     def output_footnote_link(self, m):
         global footnote_link_index
-        ret = f'<a id="footnote_link_{footnote_link_index}" class="footnote_link" href="#footnote_text_{footnote_link_index}" data-index={footnote_link_index}>[{footnote_link_index}]</a>'
+        ret = self.renderer.footnote_link(footnote_link_index)
         footnote_link_index += 1
         return ret
 
     def output_footnote_text(self, m):
         global footnote_text_index
-        ret = f'<a id="footnote_text_{footnote_text_index}" class="footnote_text" href="#footnote_link_{footnote_text_index}" data-index={footnote_text_index}>[{footnote_text_index}]</a>'
+        ret = self.renderer.footnote_text(footnote_text_index)
         footnote_text_index += 1
         return ret
 
     def output_mdash(self, m):
-        return '&mdash;'
+        return self.renderer.entity('mdash')
 
     def output_rarr(self, m):
-        return '&rarr;'
+        return self.renderer.entity('rarr')
 
     def output_larr(self, m):
-        return '&larr;'
+        return self.renderer.entity('larr')
 
     def output_supers(self, m):
         carets = len(m.group(1))
         text = m.group(2)
         text = self.output(text)
-        return f'{"<sup>" * carets}{text}{"</sup>" * carets}'
+        return self.renderer.supers(carets, text)
 
     def output_supers_one(self, m):
         return self.output_supers(m)
@@ -192,10 +449,10 @@ class VoussoirInline(mistune.InlineLexer):
         return self.output_supers(m)
 
     def output_subreddit(self, m):
-        return f'<a href="https://old.reddit.com{m.group(0)}">{m.group(0)}</a>'
+        return self.renderer.reddit_link(m.group(0))
 
     def output_redditor(self, m):
-        return f'<a href="https://old.reddit.com{m.group(0)}">{m.group(0)}</a>'
+        return self.renderer.reddit_link(m.group(0))
 
 class VoussoirBlockGrammar(mistune.BlockGrammar):
     dash_spacer = re.compile(r'^-$', re.MULTILINE)
@@ -219,6 +476,167 @@ inline = VoussoirInline(renderer)
 block = VoussoirBlock()
 VMARKDOWN = mistune.Markdown(renderer=renderer, inline=inline, block=block)
 
+# DOCUMENT TREE
+################################################################################
+class TreeRenderer:
+    '''
+    Stands in for VoussoirRenderer to make mistune build a tree instead of an
+    html string. Every renderer call becomes a node like
+    {'type': 'header', 'args': [children, 2, 'raw text'], 'kwargs': {}}, where
+    the args that were rendered children are lists of nodes. mistune joins
+    renderer output with +=, so as long as placeholder() is a list, lists of
+    nodes are what come out the other end.
+
+    The nodes are plain dicts, lists, and strings, so they pickle and json
+    just fine.
+    '''
+    def __init__(self):
+        self.options = {}
+
+    def placeholder(self):
+        return []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def make_node(*args, **kwargs):
+            return [{'type': name, 'args': list(args), 'kwargs': kwargs}]
+        return make_node
+
+TREE_MARKDOWN = mistune.Markdown(
+    renderer=TreeRenderer(),
+    inline=VoussoirInline(TreeRenderer()),
+    block=VoussoirBlock(),
+)
+
+# The node types which are blocks of their own in plain text.
+TEXT_BLOCK_NODES = {
+    'block_code', 'block_html', 'block_quote', 'footnote_item', 'footnotes',
+    'header', 'hrule', 'list', 'list_item', 'paragraph', 'table', 'table_row',
+}
+TEXT_ENTITIES = {'mdash': '\u2014', 'rarr': '\u2192', 'larr': '\u2190'}
+
+def walk_nodes(nodes):
+    for node in nodes:
+        yield node
+        for arg in node['args']:
+            if isinstance(arg, list):
+                yield from walk_nodes(arg)
+
+def render_html(nodes, html_renderer=None):
+    '''
+    Turn nodes back into exactly the html that VMARKDOWN would have made, by
+    making the same renderer calls with the children rendered first.
+    '''
+    html_renderer = renderer if html_renderer is None else html_renderer
+    output = []
+    for node in nodes:
+        args = [render_html(arg, html_renderer) if isinstance(arg, list) else arg for arg in node['args']]
+        output.append(getattr(html_renderer, node['type'])(*args, **node['kwargs']))
+    return ''.join(output)
+
+def _render_text(nodes):
+    output = []
+    for node in nodes:
+        (kind, args) = (node['type'], node['args'])
+        if kind in ('text', 'escape', 'codespan', 'block_code', 'autolink', 'reddit_link'):
+            text = html.unescape(args[0])
+        elif kind == 'image':
+            text = args[2] or ''
+        elif kind in ('inline_html', 'block_html'):
+            text = html.unescape(re.sub(r'<[^>]*>', '', args[0]))
+        elif kind == 'entity':
+            text = TEXT_ENTITIES.get(args[0], '')
+        elif kind in ('linebreak', 'newline'):
+            text = '\n'
+        else:
+            text = ''.join(_render_text(arg) for arg in args if isinstance(arg, list))
+        if kind in TEXT_BLOCK_NODES:
+            text = f'\n\n{text.strip()}\n\n'
+        output.append(text)
+    return ''.join(output)
+
+def render_text(nodes):
+    '''
+    Plain text for search indexes and excerpts. Blocks are separated by a
+    blank line, and tags and footnote markers are left out.
+    '''
+    text = _render_text(nodes)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+class Document:
+    '''
+    The parsed form of a markdown source, from which we can render html,
+    plain text, the outline, and the tags without parsing it again. Don't
+    modify one, because parse() hands out the same Document for the same
+    source.
+    '''
+    def __init__(self, nodes, footnote_links, footnote_texts):
+        self.nodes = nodes
+        self.footnote_links = footnote_links
+        self.footnote_texts = footnote_texts
+
+    def html(self):
+        return render_html(self.nodes)
+
+    def text(self):
+        return render_text(self.nodes)
+
+    def outline(self):
+        '''
+        Return (level, text, slug) for every header, with the same slugs that
+        add_header_anchors gives them.
+        '''
+        used_slugs = set()
+        outline = []
+        for node in walk_nodes(self.nodes):
+            if node['type'] != 'header':
+                continue
+            text = render_text(node['args'][0])
+            slug = uniqify_slug(slugify(text), used_slugs)
+            outline.append((node['args'][1], text, slug))
+        return outline
+
+    def title(self):
+        for (level, text, slug) in self.outline():
+            if level == 1:
+                return text
+        return None
+
+    def tags(self):
+        return [node['args'][0] for node in walk_nodes(self.nodes) if node['type'] == 'category_tag']
+
+PARSE_CACHE_SIZE = 256
+_parse_cache = collections.OrderedDict()
+
+def parse(md):
+    '''
+    Return the Document for this markdown. Documents are remembered by the
+    hash of their source, so asking for the html, the text, and the outline
+    of one file only parses it once.
+    '''
+    global footnote_link_index
+    global footnote_text_index
+    key = hashlib.sha256(md.encode('utf-8')).digest()
+    document = _parse_cache.get(key)
+    if document is not None:
+        _parse_cache.move_to_end(key)
+        _profile.count('parse_cache_hits')
+        return document
+
+    footnote_link_index = 1
+    footnote_text_index = 1
+    nodes = TREE_MARKDOWN(md)
+    document = Document(
+        nodes,
+        footnote_links=footnote_link_index - 1,
+        footnote_texts=footnote_text_index - 1,
+    )
+    _parse_cache[key] = document
+    if len(_parse_cache) > PARSE_CACHE_SIZE:
+        _parse_cache.popitem(last=False)
+    return document
+
 # GENERIC HELPERS
 ################################################################################
 def cat_file(path):
@@ -239,6 +657,18 @@ def dump_file(path):
     with open(path, 'rb') as f:
         return f.read()
 
+@functools.lru_cache(maxsize=None)
+def _guess_mimetype(extension):
+    import mimetypes
+    return mimetypes.guess_type('file' + extension)[0]
+
+def guess_mimetype(filename):
+    '''
+    Like mimetypes.guess_type but only looks at the extension, and remembers
+    the answer for next time.
+    '''
+    return _guess_mimetype(os.path.splitext(filename)[1].lower())
+
 # SOUP HELPERS
 ################################################################################
 PARAGRAPH_SYMBOL = chr(182)
@@ -330,8 +760,8 @@ def add_toc(soup, max_level=None):
             # In the resulting toc, that initial h4 would have the same
             # toc depth as the later h1 since it never had parents.
             if current_list == toc:
-                current_list['level'] = level
                 current_list = toc.ol
+                current_list['level'] = level
 
         if level > current_list['level']:
             # In order to properly render nested <ol>, you're supposed
@@ -366,32 +796,114 @@ def add_head_title(soup):
     title.append(text)
     soup.head.append(title)
 
-def embed_images(soup, cache=None):
+def image_location(src, base_dir=None):
+    '''
+    Return (location, remote) for an <img> src, where location is the url, or
+    the absolute path of a local file. Relative paths are relative to the
+    markdown file, which is base_dir, or the cwd if that's None. Image caches
+    are keyed by location, so that two documents which each have their own
+    graph.svg don't get each other's.
+    '''
+    if src.startswith('https://') or src.startswith('http://'):
+        return (src, True)
+    if base_dir is not None:
+        src = os.path.join(base_dir, src)
+    return (os.path.abspath(src), False)
+
+def embed_images(soup, cache=None, base_dir=None):
     '''
     Find <img> srcs and either download the url or load the local file,
     and convert it to a data URI.
+
+    base_dir: The directory of the markdown file, for relative srcs.
     '''
+    import mimetypes
     for element in soup.find_all('img'):
         src = element['src']
         if cache is None:
             cache = {}
-        if cache.get(src) is None:
+        (location, remote) = image_location(src, base_dir)
+        if cache.get(location) is None:
             print('Fetching %s' % src)
-            if src.startswith('https://') or src.startswith('http://'):
-                response = session.get(src)
+            _profile.count('image_fetches')
+            if remote:
+                response = get_session().get(src)
                 response.raise_for_status()
                 data = response.content
             else:
-                data = dump_file(src)
+                data = dump_file(location)
             data = base64.b64encode(data).decode('ascii')
             mime = mimetypes.guess_type(src)[0]
             mime = mime if mime is not None else ''
             uri = f'data:{mime};base64,{data}'
-            cache[src] = uri
+            cache[location] = uri
         else:
-            uri = cache[src]
+            uri = cache[location]
         element['src'] = uri
 
+def fingerprint_name(src, data):
+    '''
+    Return the basename of src with the hash of its content before the
+    extension, like graph.1a2b3c4d5e6f7a8b.svg.
+    '''
+    basename = os.path.basename(urllib.parse.urlparse(src).path) or 'image'
+    (stem, extension) = os.path.splitext(basename)
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    return f'{stem}.{digest}{extension}'
+
+def fingerprint_images(soup, assets_dir, assets_url=None, cache=None, include_remote=False, base_dir=None):
+    '''
+    The alternative to embed_images. Copy each local image into assets_dir
+    under its fingerprint_name and point the src at assets_url/name. Because
+    the name changes whenever the content does, the server can tell browsers
+    to keep them forever, and every page that uses an image shares one copy:
+
+        location /assets/ {
+            add_header Cache-Control "public, max-age=31536000, immutable";
+        }
+
+    assets_url: The url of assets_dir as seen from the html. If None, the
+    assets_dir path is used as is.
+    include_remote: If True, http(s) images are downloaded once and served
+    from assets_dir too. Otherwise they're left alone.
+    base_dir: The directory of the markdown file, for relative srcs.
+
+    If the hashed name already exists in assets_dir, it's the same content,
+    so it isn't written again.
+    '''
+    if assets_url is None:
+        assets_url = assets_dir.replace(os.sep, '/')
+    assets_url = assets_url.rstrip('/')
+    for element in soup.find_all('img'):
+        src = element['src']
+        if cache is None:
+            cache = {}
+        if src.startswith('data:'):
+            continue
+        (location, remote) = image_location(src, base_dir)
+        if cache.get(location) is None:
+            if remote and not include_remote:
+                continue
+            _profile.count('image_fetches')
+            if remote:
+                print('Fetching %s' % src)
+                response = get_session().get(src)
+                response.raise_for_status()
+                data = response.content
+            else:
+                data = dump_file(location)
+            name = fingerprint_name(src, data)
+            path = os.path.join(assets_dir, name)
+            if not os.path.exists(path):
+                os.makedirs(assets_dir, exist_ok=True)
+                # Batch workers might be writing the same asset at once.
+                temp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(temp, 'wb') as f:
+                    f.write(data)
+                os.replace(temp, path)
+            cache[location] = f'{assets_url}/{name}'
+        element['src'] = cache[location]
+
 def get_innertext(element):
     if isinstance(element, bs4.NavigableString):
         return element.string
@@ -606,118 +1118,933 @@ def set_img_lazyload(soup):
     for img in imgs:
         img['loading'] = 'lazy'
 
-# FINAL MARKDOWNS
+# Make sure to add_head_title before add_header_anchors so you don't get the
+# paragraph symbol in the <title>.
+SOUP_CLEANERS = [
+    add_head_title,
+    add_header_anchors,
+    add_toc,
+    fix_classes,
+    fix_reddit_links,
+    inject_footnotes,
+    set_img_lazyload,
+]
+# The cleaners which only ever look within one block of the document, so
+# BlockCache can run them on each block by itself.
+BLOCK_CLEANERS = [fix_classes, fix_reddit_links, set_img_lazyload]
+
+# PROFILING
 ################################################################################
-def markdown(
-        md,
-        *,
-        css=None,
-        do_embed_images=False,
-        image_cache=None,
-        return_soup=False,
-    ):
-    global footnote_link_index
-    global footnote_text_index
-    footnote_link_index = 1
-    footnote_text_index = 1
+class RenderProfile:
+    '''
+    Pass one of these to markdown(profile=...) to record the wall time and cpu
+    time spent in each stage of the render, along with some counters. The same
+    profile can be passed to many renders and it will add them all up.
+    '''
+    enabled = True
 
-    css = cat_files(css)
+    def __init__(self):
+        self.stages = {}
+        self.counters = collections.Counter()
 
-    body = VMARKDOWN(md)
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+            stage['calls'] += 1
+            stage['wall'] += time.perf_counter() - wall_start
+            stage['cpu'] += time.thread_time() - cpu_start
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def as_dict(self):
+        return {'stages': self.stages, 'counters': dict(self.counters)}
+
+    def merge(self, other):
+        '''
+        Add in the results of another profile, or of another profile's
+        as_dict, like the ones that come back from worker processes.
+        '''
+        if isinstance(other, RenderProfile):
+            other = other.as_dict()
+        for (name, theirs) in other['stages'].items():
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+            for key in stage:
+                stage[key] += theirs[key]
+        self.counters.update(other['counters'])
+
+    def table(self):
+        lines = [f'{"stage":<20} {"calls":>6} {"wall":>10} {"cpu":>10}']
+        for (name, stage) in self.stages.items():
+            lines.append(f'{name:<20} {stage["calls"]:>6} {stage["wall"]:>9.4f}s {stage["cpu"]:>9.4f}s')
+        wall = sum(stage['wall'] for stage in self.stages.values())
+        cpu = sum(stage['cpu'] for stage in self.stages.values())
+        lines.append(f'{"total":<20} {"":>6} {wall:>9.4f}s {cpu:>9.4f}s')
+        lines.append('')
+        lines.append(f'{"counter":<20} {"value":>6}')
+        for (name, value) in sorted(self.counters.items()):
+            lines.append(f'{name:<20} {value:>6}')
+        return '\n'.join(lines)
+
+class NullProfile:
+    '''
+    Stands in when no profile was asked for, so the render doesn't have to
+    check every time.
+    '''
+    enabled = False
 
-    if footnote_link_index != footnote_text_index:
-        links = footnote_link_index-1
-        texts = footnote_text_index-1
-        warnings.warn(f'There are {links} footnote links, but {texts} texts.')
+    def stage(self, name):
+        return contextlib.nullcontext()
 
-    html = HTML_TEMPLATE.format(css=css, body=body)
+    def count(self, name, amount=1):
+        pass
 
-    # HTML cleaning
-    html = html_replacements(html)
+NULL_PROFILE = NullProfile()
 
-    soup = bs4.BeautifulSoup(html, 'html.parser')
+class CurrentProfile(threading.local):
+    '''
+    The profile of the render that is currently in progress on this thread.
+    markdown() sets it so the renderer and lexers can see it, and it's per
+    thread so that the prerender pool's renders, and the embed_images that
+    they do outside of the render lock, don't count into each other's
+    profiles or reset them.
+    '''
+    profile = NULL_PROFILE
 
-    # Soup cleaning
-    # Make sure to add_head_title before add_header_anchors so you don't get
-    # the paragraph symbol in the <title>.
-    add_head_title(soup)
-    add_header_anchors(soup)
-    add_toc(soup)
-    fix_classes(soup)
-    fix_reddit_links(soup)
-    inject_footnotes(soup)
-    set_img_lazyload(soup)
+    def count(self, name, amount=1):
+        self.profile.count(name, amount)
 
-    if do_embed_images:
-        embed_images(soup, cache=image_cache)
+_profile = CurrentProfile()
 
-    if return_soup:
-        return soup
+# FILE WATCHER
+################################################################################
+class FileWatcher:
+    '''
+    Keeps a version number for each watched file which goes up whenever the
+    file's mtime or size changes, and lets threads wait for that to happen.
+
+    On Linux we use inotify on the files' parent directories. Watching the
+    directory instead of the file means we also catch editors that save by
+    renaming a new file over the old one. Where inotify isn't available, we
+    stat the files every `interval` seconds instead. That also goes for the
+    files of a directory we couldn't watch, like when we've hit the system's
+    limit on watches.
+    '''
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    INOTIFY_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    INOTIFY_EVENT = struct.Struct('iIII')
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.stamps = {}
+        self.versions = {}
+        self.directories = {}
+        # With inotify, the files in directories that couldn't be watched.
+        self.polled = set()
+        self.failed_directories = set()
+        self.polling = False
+        # Only the first failure gets printed, there tend to be many at once.
+        self.warned = False
+        self.inotify_fd = self._inotify_init()
+        if self.inotify_fd is None:
+            self._start_polling()
+        else:
+            threading.Thread(target=self._inotify_loop, daemon=True).start()
 
-    html = str(soup)
-    return html
+    @staticmethod
+    def _stamp(filename):
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _inotify_init(self):
+        try:
+            import ctypes
+            self._libc = ctypes.CDLL(None, use_errno=True)
+            fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        except (AttributeError, OSError):
+            return None
+        if fd < 0:
+            return None
+        return fd
+
+    def _check(self, filename):
+        stamp = self._stamp(filename)
+        with self.condition:
+            if stamp == self.stamps[filename]:
+                return
+            self.stamps[filename] = stamp
+            self.versions[filename] += 1
+            self.condition.notify_all()
+
+    def _inotify_loop(self):
+        while True:
+            data = os.read(self.inotify_fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = self.INOTIFY_EVENT.unpack_from(data, offset)
+                offset += self.INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                directory = self.directories.get(wd)
+                if directory is None or not name:
+                    continue
+                filename = os.path.join(directory, os.fsdecode(name))
+                if filename in self.versions:
+                    self._check(filename)
+
+    def _start_polling(self):
+        if not self.polling:
+            self.polling = True
+            threading.Thread(target=self._polling_loop, daemon=True).start()
+
+    def _polling_loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self.condition:
+                filenames = list(self.versions if self.inotify_fd is None else self.polled)
+            for filename in filenames:
+                self._check(filename)
+
+    def _add_watch(self, directory):
+        '''
+        Return True if the directory is now watched by inotify. Must be called
+        with the condition held.
+        '''
+        if directory in self.directories.values():
+            return True
+        if directory in self.failed_directories:
+            return False
+        wd = self._libc.inotify_add_watch(self.inotify_fd, os.fsencode(directory), self.INOTIFY_MASK)
+        if wd >= 0:
+            self.directories[wd] = directory
+            return True
+
+        self.failed_directories.add(directory)
+        if not self.warned:
+            self.warned = True
+            import ctypes
+            error = os.strerror(ctypes.get_errno())
+            print(f'Warning: Couldn\'t watch {directory} with inotify ({error}), polling instead.')
+        return False
+
+    def watch(self, filename):
+        filename = os.path.abspath(filename)
+        with self.condition:
+            if filename in self.versions:
+                return
+            self.versions[filename] = 0
+            self.stamps[filename] = self._stamp(filename)
+            if self.inotify_fd is not None and not self._add_watch(os.path.dirname(filename)):
+                self.polled.add(filename)
+                self._start_polling()
+
+    def snapshot(self, filenames):
+        with self.condition:
+            return [self.versions[os.path.abspath(filename)] for filename in filenames]
+
+    def wait(self, filenames, snapshot, timeout=None):
+        '''
+        Block until any of the files has a different version than it did in
+        the snapshot. Return the new snapshot, or None if the timeout passed.
+        '''
+        with self.condition:
+            changed = self.condition.wait_for(
+                lambda: self.snapshot(filenames) != snapshot,
+                timeout=timeout,
+            )
+            if not changed:
+                return None
+            return self.snapshot(filenames)
+
+# BLOCK CACHE
+################################################################################
+def group_tokens(tokens):
+    '''
+    Split the block lexer's tokens into the top-level blocks of the document.
+    The *_start and *_end tokens of lists, quotes, and footnotes nest, and a
+    run of loose text tokens is one block because mistune joins them into one
+    paragraph.
+    '''
+    groups = []
+    depth = 0
+    for token in tokens:
+        kind = token['type']
+        joins_text = kind == 'text' and groups and groups[-1][-1]['type'] == 'text'
+        if depth == 0 and not joins_text:
+            groups.append([])
+        groups[-1].append(token)
+        if kind.endswith('_start'):
+            depth += 1
+        elif kind.endswith('_end'):
+            depth -= 1
+    return groups
+
+def shift_footnotes(nodes, link_offset, text_offset):
+    '''
+    Return a copy of the nodes with the footnote indices moved up by the
+    number of footnotes in the blocks before them.
+    '''
+    if not (link_offset or text_offset):
+        return nodes
+    shifted = []
+    for node in nodes:
+        args = [
+            shift_footnotes(arg, link_offset, text_offset) if isinstance(arg, list) else arg
+            for arg in node['args']
+        ]
+        if node['type'] == 'footnote_link':
+            args[0] += link_offset
+        elif node['type'] == 'footnote_text':
+            args[0] += text_offset
+        shifted.append({**node, 'args': args})
+    return shifted
+
+VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+    'param', 'source', 'track', 'wbr',
+}
+
+class _BalanceChecker(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.stack = []
+        self.balanced = True
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in VOID_ELEMENTS:
+            return
+        if not self.stack or self.stack.pop() != tag:
+            self.balanced = False
+
+def is_balanced(html_text):
+    '''
+    Return True if every tag in the html is closed inside of it, in order.
+    Only then is the html parsed the same by itself as it is in the middle of
+    the whole page.
+    '''
+    checker = _BalanceChecker()
+    checker.feed(html_text)
+    checker.close()
+    return checker.balanced and not checker.stack
+
+# What bs4 considers whitespace. It collapses strings of nothing but these to
+# a single newline or space.
+ASCII_SPACES = ' \n\t\x0c\r'
+
+def clean_fragment(html_text):
+    '''
+    Run the BLOCK_CLEANERS over the html of one block, or return False if
+    the result wouldn't be the same as it is in the middle of the page. That's
+    when the html begins or ends with text, which bs4 would merge with the
+    whitespace around it.
+    '''
+    soup = bs4.BeautifulSoup(html_replacements(html_text), 'html.parser')
+    if not soup.contents:
+        return False
+    for edge in (soup.contents[0], soup.contents[-1]):
+        if isinstance(edge, bs4.NavigableString) and not isinstance(edge, bs4.Comment):
+            return False
+    for cleaner in BLOCK_CLEANERS:
+        cleaner(soup)
+    return str(soup)
+
+# Non-page-wide blocks are swapped out for these in the skeleton page.
+BLOCK_PLACEHOLDER = '<!--vmarkdown_block_{index}-->'
+BLOCK_PLACEHOLDER_PATTERN = re.compile(r'<!--vmarkdown_block_(\d+)-->')
+
+# The nodes which the page-wide cleaners care about: headers get their slugs,
+# the toc, and the <title>, and footnotes get their hover text.
+PAGE_WIDE_NODES = {'header', 'footnote_link', 'footnote_text'}
+
+class CachedBlock:
+    def __init__(self, nodes, footnote_links, footnote_texts):
+        self.nodes = nodes
+        self.footnote_links = footnote_links
+        self.footnote_texts = footnote_texts
+        self.page_wide = any(node['type'] in PAGE_WIDE_NODES for node in walk_nodes(nodes))
+        self.balanced = None
+        # The html for each (link_offset, text_offset) this block has been
+        # rendered at. Blocks without footnotes only ever need (0, 0).
+        self.html = {}
+        # The html after BLOCK_CLEANERS, for blocks that aren't page-wide, or
+        # False if the block can't be pasted into the page separately.
+        self.cleaned = None
+
+class BlockCache:
+    '''
+    Renders markdown one top-level block at a time and remembers each block by
+    the hash of its tokens, so that when you edit one sentence of a long
+    article in markdown_flask, only that paragraph goes through the inline
+    lexer, none of the code blocks go back through pygments, and none of them
+    are souped and cleaned again.
+
+    Footnote numbers are global to the document, so each block is parsed with
+    its own footnotes starting at 1 and then shifted into place at render
+    time. The cleaners which need the whole page (the title, header slugs,
+    toc, and footnote hover text) run on a skeleton of the page which only
+    has the blocks with headers and footnotes, and the other blocks are
+    cleaned once on their own and pasted in afterwards.
+
+    The block lexer still runs over the whole source each time, but that's
+    regexes over the raw text, which is cheap next to everything else.
+
+    The output is exactly what markdown() makes without a BlockCache. A
+    document that uses mistune's own [^key] footnotes is parsed whole, since
+    those are collected at the end, and if a block's html has tags that
+    aren't closed within it, the page goes through the whole soup as usual.
+
+    Like parse(), this shares TREE_MARKDOWN, so only one thread at a time.
+    '''
+    def __init__(self, max_blocks=4096):
+        self.max_blocks = max_blocks
+        self.blocks = collections.OrderedDict()
+        self.block_lexer = VoussoirBlock()
+
+    def tokenize(self, md):
+        lexer = self.block_lexer
+        lexer.tokens = []
+        lexer.def_links = {}
+        lexer.def_footnotes = {}
+        tokens = lexer(mistune.preprocessing(md))
+        return (tokens, lexer.def_links, lexer.def_footnotes)
+
+    def _parse_group(self, group, def_links):
+        global footnote_link_index
+        global footnote_text_index
+        footnote_link_index = 1
+        footnote_text_index = 1
+        tree = TREE_MARKDOWN
+        # mistune pops the tokens off the end.
+        tree.tokens = group[::-1]
+        tree.inline.setup(def_links, {})
+        try:
+            nodes = tree.renderer.placeholder()
+            while tree.pop():
+                nodes += tree.tok()
+        finally:
+            tree.inline.links = {}
+        return CachedBlock(
+            nodes,
+            footnote_links=footnote_link_index - 1,
+            footnote_texts=footnote_text_index - 1,
+        )
+
+    def _get_block(self, group, links_key, def_links):
+        key = json.dumps(group, sort_keys=True) + links_key
+        key = hashlib.sha256(key.encode('utf-8')).digest()
+        block = self.blocks.get(key)
+        if block is None:
+            block = self._parse_group(group, def_links)
+            self.blocks[key] = block
+            if len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        else:
+            self.blocks.move_to_end(key)
+            _profile.count('block_cache_hits')
+        return block
+
+    def render(self, md):
+        '''
+        Return (pieces, footnote_links, footnote_texts), where pieces is a
+        list of (block, html) which join up into the html of the document.
+        '''
+        (tokens, def_links, def_footnotes) = self.tokenize(md)
+        if def_footnotes:
+            document = parse(md)
+            return ([(None, document.html())], document.footnote_links, document.footnote_texts)
+
+        # Reference-style links are defined anywhere in the document, so a
+        # change to any of them has to invalidate every block.
+        links_key = json.dumps(def_links, sort_keys=True)
+        pieces = []
+        link_offset = 0
+        text_offset = 0
+        for group in group_tokens(tokens):
+            block = self._get_block(group, links_key, def_links)
+            if block.footnote_links or block.footnote_texts:
+                offsets = (link_offset, text_offset)
+            else:
+                offsets = (0, 0)
+            html_text = block.html.get(offsets)
+            if html_text is None:
+                html_text = render_html(shift_footnotes(block.nodes, *offsets))
+                # Adding a footnote early in the document moves all the later
+                # ones, so don't let the old positions pile up.
+                if len(block.html) >= 4:
+                    block.html.clear()
+                block.html[offsets] = html_text
+            pieces.append((block, html_text))
+            link_offset += block.footnote_links
+            text_offset += block.footnote_texts
+
+        return (pieces, link_offset, text_offset)
+
+    def assemble(self, pieces, css):
+        '''
+        Return the finished, cleaned html page for the pieces from render(),
+        or None if they can't be cleaned separately and the caller should
+        soup the whole page instead.
+        '''
+        skeleton = []
+        fragments = []
+        for (block, html_text) in pieces:
+            if block is None:
+                return None
+            if block.balanced is None:
+                block.balanced = is_balanced(html_text)
+            if not block.balanced:
+                return None
+            core = html_text.strip(ASCII_SPACES)
+            if block.page_wide or not core:
+                skeleton.append(html_text)
+                continue
+            if block.cleaned is None:
+                block.cleaned = clean_fragment(core)
+            if block.cleaned is False:
+                skeleton.append(html_text)
+                continue
+            # The whitespace between blocks stays in the skeleton so that bs4
+            # collapses it the same way it would in the whole page.
+            lead = len(html_text) - len(html_text.lstrip(ASCII_SPACES))
+            trail = len(html_text.rstrip(ASCII_SPACES))
+            skeleton.append(html_text[:lead])
+            skeleton.append(BLOCK_PLACEHOLDER.format(index=len(fragments)))
+            skeleton.append(html_text[trail:])
+            fragments.append(block.cleaned)
+
+        html_text = HTML_TEMPLATE.format(css=css, body=''.join(skeleton))
+        soup = bs4.BeautifulSoup(html_replacements(html_text), 'html.parser')
+        for cleaner in SOUP_CLEANERS:
+            cleaner(soup)
+        html_text = str(soup)
+        return BLOCK_PLACEHOLDER_PATTERN.sub(lambda match: fragments[int(match.group(1))], html_text)
+
+# RENDER CACHE
+################################################################################
+def stamp_token(stamp):
+    return hashlib.sha1(repr(stamp).encode('utf-8')).hexdigest()[:16]
+
+# The server only ever asks for the plain page and the one with the live
+# reload script, but the variants are bounded anyway so that no caller can
+# grow a page without limit.
+VARIANTS_SIZE = 4
+
+class RenderedPage:
+    def __init__(self, html, stamp, last_modified):
+        self.html = html
+        self.stamp = stamp
+        self.last_modified = last_modified
+        self.variants = collections.OrderedDict()
+        self.variants_lock = threading.Lock()
+
+    def variant(self, suffix=''):
+        '''
+        Return (body, gzipped, etag) for the html with the given suffix added,
+        computing them the first time each suffix is asked for, and keeping
+        the VARIANTS_SIZE most recent.
+        '''
+        with self.variants_lock:
+            variant = self.variants.get(suffix)
+            if variant is not None:
+                self.variants.move_to_end(suffix)
+                return variant
+
+        body = (self.html + suffix).encode('utf-8')
+        gzipped = gzip.compress(body)
+        etag = hashlib.sha1(body).hexdigest()
+        variant = (body, gzipped, etag)
+        with self.variants_lock:
+            self.variants[suffix] = variant
+            while len(self.variants) > VARIANTS_SIZE:
+                self.variants.popitem(last=False)
+        return variant
+
+class RenderCache:
+    '''
+    Keeps the rendered html of markdown files, so they are only re-rendered
+    when the file or one of the css files changes its mtime or size.
+
+    markdown() is not safe to call from multiple threads at once, because of
+    the footnote counters and the shared mistune instance, so that part goes
+    through one lock. Embedding images and turning the soup into a string
+    happen outside of it, so other files can render in the meantime.
+
+    Each file also has its own lock, so when several requests for the same
+    stale file arrive together, the first one renders it and the rest find it
+    in the cache once they get the lock.
+
+    Renders go through a BlockCache, so saving a small edit to a long article
+    only re-renders the blocks that you touched.
+    '''
+    def __init__(self, *, do_embed_images=False, image_cache=None, **markdown_kwargs):
+        self.do_embed_images = do_embed_images
+        self.image_cache = {} if image_cache is None else image_cache
+        self.markdown_kwargs = markdown_kwargs
+        css = markdown_kwargs.get('css')
+        if css is None:
+            css = []
+        elif isinstance(css, str):
+            css = [css]
+        self.css_files = list(css)
+        self.pages = {}
+        self.blocks = BlockCache()
+        self.lock = threading.Lock()
+        self.file_locks = {}
+        self.file_locks_lock = threading.Lock()
+
+    def _file_lock(self, filename):
+        with self.file_locks_lock:
+            return self.file_locks.setdefault(filename, threading.Lock())
+
+    def stamp(self, filename):
+        stats = [os.stat(f) for f in [filename, *self.css_files]]
+        return tuple((stat.st_mtime_ns, stat.st_size) for stat in stats)
+
+    def get(self, filename):
+        '''
+        Return the RenderedPage for this file, rendering it if needed. Raises
+        FileNotFoundError if the file doesn't exist.
+        '''
+        if isinstance(filename, pathclass.Path):
+            filename = filename.absolute_path
+
+        stamp = self.stamp(filename)
+        page = self.pages.get(filename)
+        if page is not None and page.stamp == stamp:
+            return page
+
+        with self._file_lock(filename):
+            stamp = self.stamp(filename)
+            page = self.pages.get(filename)
+            if page is not None and page.stamp == stamp:
+                return page
+
+            md = cat_file(filename)
+            base_dir = os.path.dirname(filename)
+            if self.do_embed_images:
+                with self.lock:
+                    soup = markdown(md, blocks=self.blocks, return_soup=True, **self.markdown_kwargs)
+                embed_images(soup, cache=self.image_cache, base_dir=base_dir)
+                html = str(soup)
+            else:
+                with self.lock:
+                    html = markdown(md, blocks=self.blocks, base_dir=base_dir, **self.markdown_kwargs)
+
+            mtime = max(mtime_ns for (mtime_ns, size) in stamp) / 1e9
+            last_modified = datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc)
+            page = RenderedPage(html, stamp=stamp, last_modified=last_modified)
+            self.pages[filename] = page
+            return page
+
+    def prerender(self, filenames, jobs=4):
+        '''
+        Render all of the given files on a background thread pool so they're
+        already in the cache by the time anyone asks for them. Progress and
+        timing are printed as it goes. Returns the thread which is overseeing
+        the pool, in case you want to join it.
+        '''
+        import concurrent.futures
+        filenames = list(filenames)
+
+        def render(filename):
+            start = time.perf_counter()
+            self.get(filename)
+            return time.perf_counter() - start
+
+        def oversee():
+            start = time.perf_counter()
+            print(f'Prerendering {len(filenames)} files with {jobs} threads.')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = {executor.submit(render, filename): filename for filename in filenames}
+                done = 0
+                for future in concurrent.futures.as_completed(futures):
+                    done += 1
+                    filename = futures[future]
+                    try:
+                        elapsed = future.result()
+                    except Exception:
+                        traceback.print_exc()
+                        print(f'Prerender {done}/{len(filenames)} failed: {filename}')
+                    else:
+                        print(f'Prerender {done}/{len(filenames)} {elapsed:.3f}s {filename}')
+            print(f'Prerendered {len(filenames)} files in {time.perf_counter() - start:.3f}s.')
+
+        thread = threading.Thread(target=oversee, daemon=True)
+        thread.start()
+        return thread
+
+# FINAL MARKDOWNS
+################################################################################
+def markdown(
+        md,
+        *,
+        css=None,
+        css_text=None,
+        do_embed_images=False,
+        image_cache=None,
+        assets_dir=None,
+        assets_url=None,
+        fingerprint_remote=False,
+        base_dir=None,
+        blocks=None,
+        profile=None,
+        return_soup=False,
+    ):
+    '''
+    css: A filename or list of filenames whose contents go in the <style>.
+    css_text: The already-read css, to save reading the same files again when
+    rendering many documents. If given, `css` is ignored.
+    assets_dir, assets_url, fingerprint_remote: If assets_dir is given, images
+    are copied there under content-hashed names instead of being embedded. See
+    fingerprint_images.
+    base_dir: The directory of the markdown file, which relative image srcs
+    are relative to. If None, they're relative to the cwd.
+    blocks: A BlockCache, so that only the blocks which changed since the
+    last render get parsed and rendered again.
+    profile: A RenderProfile which will record the time spent in each stage.
+    '''
+    if do_embed_images and assets_dir is not None:
+        raise ValueError('Images can be embedded or fingerprinted, not both.')
+
+    profile = NULL_PROFILE if profile is None else profile
+    previous_profile = _profile.profile
+    _profile.profile = profile
+
+    try:
+        with profile.stage('read_css'):
+            if css_text is None:
+                css_text = cat_files(css)
+        css = css_text
+
+        if blocks is None:
+            with profile.stage('parse'):
+                document = parse(md)
+            with profile.stage('render_html'):
+                body = document.html()
+            links = document.footnote_links
+            texts = document.footnote_texts
+        else:
+            with profile.stage('render_blocks'):
+                (pieces, links, texts) = blocks.render(md)
+            body = ''.join(html for (block, html) in pieces)
+
+        if links != texts:
+            warnings.warn(f'There are {links} footnote links, but {texts} texts.')
+
+        if blocks is not None and not (return_soup or do_embed_images or assets_dir is not None):
+            with profile.stage('assemble_blocks'):
+                html = blocks.assemble(pieces, css)
+            if html is not None:
+                return html
+
+        html = HTML_TEMPLATE.format(css=css, body=body)
+
+        # HTML cleaning
+        with profile.stage('html_replacements'):
+            html = html_replacements(html)
+
+        with profile.stage('soup_parse'):
+            soup = bs4.BeautifulSoup(html, 'html.parser')
+
+        if profile.enabled:
+            profile.count('soup_nodes', len(soup.find_all(True)))
+
+        # Soup cleaning
+        for cleaner in SOUP_CLEANERS:
+            with profile.stage(cleaner.__name__):
+                cleaner(soup)
+
+        if do_embed_images:
+            with profile.stage('embed_images'):
+                embed_images(soup, cache=image_cache, base_dir=base_dir)
+
+        if assets_dir is not None:
+            with profile.stage('fingerprint_images'):
+                fingerprint_images(
+                    soup,
+                    assets_dir=assets_dir,
+                    assets_url=assets_url,
+                    cache=image_cache,
+                    include_remote=fingerprint_remote,
+                    base_dir=base_dir,
+                )
+
+        if return_soup:
+            return soup
+
+        with profile.stage('str_soup'):
+            html = str(soup)
+        return html
+    finally:
+        _profile.profile = previous_profile
 
-def markdown_flask(core_filename, port, *args, **kwargs):
+def markdown_flask(core_filename, port, *args, prerender=False, prerender_jobs=4, **kwargs):
+    '''
+    prerender: If True, render every .md file under core_filename on
+    background threads at startup, so the first view of each is a cache hit.
+    '''
     import flask
     from flask import request
     site = flask.Flask(__name__)
     image_cache = {}
     kwargs['image_cache'] = image_cache
+    render_cache = RenderCache(**kwargs)
+    watcher = FileWatcher()
     core_filename = pathclass.Path(core_filename, force_sep='/')
     if core_filename.is_dir:
         cwd = core_filename
     else:
         cwd = pathclass.cwd()
 
+    if prerender:
+        if core_filename.is_dir:
+            filenames = [
+                os.path.join(root, name)
+                for (root, dirs, files) in os.walk(core_filename.absolute_path)
+                for name in sorted(files)
+                if name.lower().endswith('.md')
+            ]
+        else:
+            filenames = [core_filename.absolute_path]
+        render_cache.prerender(filenames, jobs=prerender_jobs)
+
+    listing_cache = {}
+
     def handle_path(path):
         if path.extension == '.md':
             return do_md_for(path)
 
         if path.is_dir:
-            atags = []
-            children = sorted(path.listdir(), key=lambda p: (p.is_file, p.basename.lower()))
-            for child in children:
-                relative = child.relative_to(cwd, simple=True)
-                a = f'<p><a href="/{relative}">{child.basename}</a></p>'
-                atags.append(a)
-            atags = '\n'.join(atags)
-            page = f'''
-            <html>
-            <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0"/>
-            </head>
-            <body>
-            {atags}
-            </body>
-            </html>
-            '''.strip()
-            return page
-
-        try:
-            content = open(path.absolute_path, 'rb').read()
-        except Exception as exc:
-            print(exc)
+            return do_listing_for(path)
+
+        return do_static_for(path)
+
+    def do_listing_for(path):
+        '''
+        The listing only changes when entries are added, removed, or renamed,
+        which is exactly when the directory's mtime changes.
+        '''
+        mtime = os.stat(path.absolute_path).st_mtime_ns
+        cached = listing_cache.get(path.absolute_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        atags = []
+        children = sorted(path.listdir(), key=lambda p: (p.is_file, p.basename.lower()))
+        for child in children:
+            relative = child.relative_to(cwd, simple=True)
+            a = f'<p><a href="/{relative}">{child.basename}</a></p>'
+            atags.append(a)
+        atags = '\n'.join(atags)
+        page = f'''
+        <html>
+        <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0"/>
+        </head>
+        <body>
+        {atags}
+        </body>
+        </html>
+        '''.strip()
+        listing_cache[path.absolute_path] = (mtime, page)
+        return page
+
+    def do_static_for(path):
+        '''
+        send_file streams the file through the server's file wrapper, which
+        uses sendfile where the server supports it, and handles Range
+        requests so seeking in a <video> only fetches what it needs.
+        '''
+        if not path.is_file:
             flask.abort(404)
+        response = flask.send_file(
+            path.absolute_path,
+            mimetype=guess_mimetype(path.absolute_path),
+            conditional=True,
+            etag=True,
+        )
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def cached_response(body, gzipped, etag, last_modified, mimetype):
+        if 'gzip' in request.accept_encodings:
+            response = flask.make_response(gzipped)
+            response.headers['Content-Encoding'] = 'gzip'
+            etag += '-gzip'
         else:
-            response = flask.make_response(content)
-
-            mime = mimetypes.guess_type(path.absolute_path)[0]
-            if mime:
-                response.headers['Content-Type'] = mime
+            response = flask.make_response(body)
+        response.headers['Content-Type'] = mimetype
+        # The browser may keep a copy but must ask us if it's still good.
+        response.headers['Cache-Control'] = 'no-cache'
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response.make_conditional(request)
+
+    def do_events_for(filename, token):
+        '''
+        Hold a text/event-stream open until the markdown file or the css
+        changes, then send one change event with the new token and end. The
+        page reconnects after it has swapped in the new content.
+        '''
+        filenames = [filename.absolute_path, *render_cache.css_files]
+        for f in filenames:
+            watcher.watch(f)
+        snapshot = watcher.snapshot(filenames)
+
+        def current_token():
+            try:
+                return stamp_token(render_cache.stamp(filename.absolute_path))
+            except FileNotFoundError:
+                return ''
+
+        def stream():
+            nonlocal snapshot
+            new_token = current_token()
+            while new_token == token:
+                new_snapshot = watcher.wait(filenames, snapshot, timeout=15)
+                if new_snapshot is None:
+                    # Lets us notice when the client has gone away.
+                    yield ': keepalive\n\n'
+                    continue
+                snapshot = new_snapshot
+                new_token = current_token()
+            yield f'event: change\ndata: {new_token}\n\n'
 
-            return response
+        response = flask.Response(stream(), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
 
     def do_md_for(filename):
+        if 'events' in request.args:
+            return do_events_for(filename, request.args['events'])
         try:
-            html = markdown(md=cat_file(filename), *args, **kwargs)
+            page = render_cache.get(filename)
         except FileNotFoundError:
             flask.abort(404)
-        refresh = request.args.get('refresh', None)
-        if refresh is not None:
-            refresh = 1000 * max(float(refresh), 1)
-            html += f'<script>setTimeout(function(){{window.location.reload()}}, {refresh})</script>'
-        return html
+        suffix = ''
+        if 'refresh' in request.args:
+            suffix = LIVE_RELOAD_SCRIPT.format(token=stamp_token(page.stamp))
+        (body, gzipped, etag) = page.variant(suffix)
+        return cached_response(body, gzipped, etag, page.last_modified, 'text/html; charset=utf-8')
 
     @site.route('/')
     def root():
@@ -732,24 +2059,195 @@ def markdown_flask(core_filename, port, *args, **kwargs):
 
     site.run(host='0.0.0.0', port=port)
 
+def _batch_init(kwargs):
+    global _batch_kwargs
+    _batch_kwargs = kwargs
+
+def _batch_render(md_filename, output_filename):
+    '''
+    Returns (seconds, profile) where profile is the as_dict of a fresh
+    RenderProfile if _batch_kwargs has profile=True, else None. Profiles can't
+    be shared with worker processes, so they send theirs back to be merged.
+    '''
+    kwargs = dict(_batch_kwargs)
+    profile = None
+    if kwargs.get('profile') is True:
+        profile = RenderProfile()
+        kwargs['profile'] = profile
+    elif kwargs.get('profile') is False:
+        kwargs['profile'] = None
+    start = time.perf_counter()
+    html = markdown(cat_file(md_filename), base_dir=os.path.dirname(md_filename), **kwargs)
+    with open(output_filename, 'w', encoding='utf-8') as f:
+        f.write(html)
+    elapsed = time.perf_counter() - start
+    return (elapsed, profile.as_dict() if profile else None)
+
+def markdown_batch(md_filenames, output_dir, *, jobs=1, css=None, profile=None, **kwargs):
+    '''
+    Render many markdown files into output_dir as basename.html, all in this
+    one process or spread across `jobs` worker processes. The css is read once
+    up front, and all of the files share one image cache, keyed by absolute
+    path so relative srcs stay relative to their own file. If a RenderProfile
+    is given, it collects the stages of every file.
+
+    Returns a list of (md_filename, seconds) in the order given.
+    '''
+    output_dir = pathclass.Path(output_dir)
+    output_dir.makedirs(exist_ok=True)
+
+    pairs = []
+    claimed = {}
+    for md_filename in md_filenames:
+        md_file = pathclass.Path(md_filename)
+        output_file = output_dir.with_child(md_file.replace_extension('html').basename)
+        if output_file == md_file:
+            raise ValueError('md file and output file are the same!')
+        if output_file in claimed:
+            raise ValueError(f'{md_file} and {claimed[output_file]} would both write {output_file}.')
+        claimed[output_file] = md_file
+        pairs.append((md_file.absolute_path, output_file.absolute_path))
+
+    kwargs['css_text'] = cat_files(css)
+
+    def collect(results):
+        timings = []
+        for ((md, output), (seconds, their_profile)) in zip(pairs, results):
+            if their_profile is not None:
+                profile.merge(their_profile)
+            timings.append((md, seconds))
+        return timings
+
+    if jobs <= 1:
+        if kwargs.get('image_cache') is None:
+            kwargs['image_cache'] = {}
+        kwargs['profile'] = profile
+        _batch_init(kwargs)
+        return collect(_batch_render(md, output) for (md, output) in pairs)
+
+    kwargs['profile'] = profile is not None
+
+    import concurrent.futures
+    import multiprocessing
+
+    def run_pool(kwargs):
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_batch_init,
+            initargs=(kwargs,),
+        )
+        with executor:
+            futures = [executor.submit(_batch_render, md, output) for (md, output) in pairs]
+            return collect(future.result() for future in futures)
+
+    if not kwargs.get('do_embed_images') and kwargs.get('assets_dir') is None:
+        return run_pool(kwargs)
+
+    # The workers can't share a plain dict, so they go through a manager.
+    with multiprocessing.Manager() as manager:
+        kwargs['image_cache'] = manager.dict(kwargs.get('image_cache') or {})
+        return run_pool(kwargs)
+
 # COMMAND LINE
 ################################################################################
+def markdown_batch_argparse(args, md_filenames, kwargs):
+    jobs = args.jobs or 1
+    start = time.perf_counter()
+    timings = markdown_batch(
+        md_filenames,
+        output_dir=args.output_dir,
+        jobs=jobs,
+        **kwargs,
+    )
+    elapsed = time.perf_counter() - start
+
+    for (md_filename, seconds) in sorted(timings, key=lambda t: t[1], reverse=True):
+        print(f'{seconds:8.3f}s {md_filename}')
+    rendering = sum(seconds for (md_filename, seconds) in timings)
+    print(f'{len(timings)} files in {elapsed:.3f}s ({rendering:.3f}s rendering, {jobs} jobs).')
+
+def report_profile(args, profile):
+    '''
+    The table goes to stderr so it doesn't get mixed into html on stdout.
+    '''
+    if args.profile:
+        print(profile.table(), file=sys.stderr)
+    if args.profile_json:
+        with open(args.profile_json, 'w', encoding='utf-8') as f:
+            json.dump(profile.as_dict(), f, indent=4)
+
 def markdown_argparse(args):
-    if args.output_filename:
-        md_file = pathclass.Path(args.md_filename)
-        output_file = pathclass.Path(args.output_filename)
-        if md_file == output_file:
-            raise ValueError('md file and output file are the same!')
+    profile = None
+    if args.profile or args.profile_json:
+        profile = RenderProfile()
+
+    if args.cprofile:
+        import cProfile
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+
+    try:
+        return _markdown_argparse(args, profile)
+    finally:
+        if args.cprofile:
+            cprofile.disable()
+            cprofile.dump_stats(args.cprofile)
+        if profile is not None:
+            report_profile(args, profile)
+
+def _markdown_argparse(args, profile):
+    md_filenames = []
+    for pattern in args.md_filenames:
+        if winglob.is_glob(pattern):
+            md_filenames.extend(sorted(winglob.glob(pattern, recursive=True)))
+        else:
+            md_filenames.append(pattern)
 
     kwargs = {
         'css': args.css,
         'do_embed_images': args.do_embed_images,
     }
 
+    if args.assets_dir:
+        assets_url = args.assets_url
+        if assets_url is None:
+            # Relative to where the html goes, so the output can be moved.
+            html_dir = args.output_dir or os.path.dirname(args.output_filename or '') or '.'
+            assets_url = os.path.relpath(args.assets_dir, html_dir).replace(os.sep, '/')
+        kwargs['assets_dir'] = args.assets_dir
+        kwargs['assets_url'] = assets_url
+        kwargs['fingerprint_remote'] = args.fingerprint_remote
+
     if args.server:
-        return markdown_flask(core_filename=args.md_filename, port=args.server, **kwargs)
+        if len(md_filenames) != 1:
+            raise ValueError('--server takes exactly one file or directory.')
+        return markdown_flask(
+            core_filename=md_filenames[0],
+            port=args.server,
+            prerender=args.prerender,
+            prerender_jobs=args.jobs or os.cpu_count() or 1,
+            **kwargs,
+        )
+
+    if args.output_dir:
+        return markdown_batch_argparse(args, md_filenames, {**kwargs, 'profile': profile})
+
+    if len(md_filenames) != 1:
+        raise ValueError('Use --output_dir to render more than one file.')
+    md_filename = md_filenames[0]
 
-    html = markdown(cat_file(args.md_filename), **kwargs)
+    if args.output_filename:
+        md_file = pathclass.Path(md_filename)
+        output_file = pathclass.Path(args.output_filename)
+        if md_file == output_file:
+            raise ValueError('md file and output file are the same!')
+
+    html = markdown(
+        cat_file(md_filename),
+        base_dir=os.path.dirname(os.path.abspath(md_filename)),
+        profile=profile,
+        **kwargs,
+    )
 
     if args.output_filename:
         f = open(args.output_filename, 'w', encoding='utf-8')
@@ -762,11 +2260,22 @@ def markdown_argparse(args):
 def main(argv):
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('md_filename')
+    parser.add_argument('md_filenames', nargs='+')
     parser.add_argument('--css', dest='css', action='append', default=None)
     parser.add_argument('--embed_images', '--embed-images', dest='do_embed_images', action='store_true')
+    parser.add_argument('--assets_dir', '--assets-dir', dest='assets_dir', default=None)
+    parser.add_argument('--assets_url', '--assets-url', dest='assets_url', default=None)
+    parser.add_argument('--fingerprint_remote', '--fingerprint-remote', dest='fingerprint_remote', action='store_true')
     parser.add_argument('-o', '--output', dest='output_filename', default=None)
+    parser.add_argument('--output_dir', '--output-dir', dest='output_dir', default=None)
+    # Worker processes for --output_dir, default 1. With --server --prerender,
+    # the prerender threads, default one per cpu.
+    parser.add_argument('--jobs', dest='jobs', type=int, default=None)
     parser.add_argument('--server', dest='server', type=int, default=None)
+    parser.add_argument('--prerender', dest='prerender', action='store_true')
+    parser.add_argument('--profile', dest='profile', action='store_true')
+    parser.add_argument('--profile_json', '--profile-json', dest='profile_json', default=None)
+    parser.add_argument('--cprofile', dest='cprofile', default=None)
     parser.set_defaults(func=markdown_argparse)
 
     args = parser.parse_args(argv)